@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Usage:
+# scripts/maint/checkUpdateFallbackDirs.py
+#
+# Checks the parts of updateFallbackDirs.py that we can check without the
+# network:
+# - the DirPort consensus download check, against a local HTTP server that
+#   stands in for a relay's DirPort, and
+# - the streaming JSON parser we use for onionoo documents, with documents
+#   split into chunks at every possible place.
+#
+# Prints "ok" or "FAIL" for each check, and exits with status 1 if any of
+# them failed.
+#
+# Needs the same python packages as updateFallbackDirs.py
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import datetime
+import gzip
+import imp
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import zlib
+
+ufd = imp.load_source('updateFallbackDirs',
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'updateFallbackDirs.py'))
+
+## DirPort Stand-In
+
+# The number of router lines in the consensus we serve
+CONSENSUS_ROUTER_COUNT = 20000
+
+# The number of seconds we let the slow server take before timing out
+SLOW_MAX_TIME = 0.2
+
+def make_consensus(valid_until):
+  return ('network-status-version 3 microdesc\n' +
+          'vote-status consensus\n' +
+          'valid-after 2017-02-20 11:00:00\n' +
+          'fresh-until 2017-02-20 12:00:00\n' +
+          'valid-until %s\n'%(valid_until.strftime('%Y-%m-%d %H:%M:%S'),) +
+          'r relay AAAA 2017-02-20 10:00:00 127.0.0.1 9001 9030\n' *
+            CONSENSUS_ROUTER_COUNT +
+          'directory-signature 0 1\n' +
+          '-----BEGIN SIGNATURE-----\nabc\n-----END SIGNATURE-----\n')
+
+def gzip_compress(text):
+  buf = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=buf, mode='w') as f:
+    f.write(text)
+  return buf.getvalue()
+
+# serves a consensus at every path, in the way that server.mode says
+class DirPortHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.0'
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    mode = self.server.mode
+    if mode == '404':
+      self.send_response(404)
+      self.end_headers()
+      return
+    body = make_consensus(self.server.valid_until)
+    if mode == 'truncated':
+      body = body[:len(body)/2]
+    elif mode == 'not-consensus':
+      body = '<html>Not a consensus</html>\n'
+    if mode == 'gzip':
+      (encoding, data) = ('gzip', gzip_compress(body))
+    elif mode == 'identity':
+      (encoding, data) = (None, body)
+    else:
+      (encoding, data) = ('deflate', zlib.compress(body))
+    self.send_response(200)
+    if encoding is not None:
+      self.send_header('Content-Encoding', encoding)
+    self.end_headers()
+    if mode == 'slow':
+      # take much longer than SLOW_MAX_TIME to send the whole consensus
+      for i in range(0, len(data), 1000):
+        self.wfile.write(data[i:i+1000])
+        self.wfile.flush()
+        time.sleep(0.05)
+    else:
+      self.wfile.write(data)
+
+class DirPortServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, address_family=socket.AF_INET):
+    self.address_family = address_family
+    BaseHTTPServer.HTTPServer.__init__(self, address, DirPortHandler)
+    self.mode = 'deflate'
+    # whole seconds, like the consensus
+    self.valid_until = (datetime.datetime.utcnow().replace(microsecond=0) +
+                        datetime.timedelta(hours=2))
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+## Checks
+
+# run check(), and report whether it raised an exception
+# returns True if the check passed
+def run_check(desc, check):
+  try:
+    check()
+  except Exception, e:
+    print 'FAIL: %s'%(desc,)
+    print '    %s: %s'%(type(e).__name__, e)
+    return False
+  print 'ok: %s'%(desc,)
+  return True
+
+def expect_exception(exception_type, f, *args):
+  try:
+    f(*args)
+  except exception_type:
+    return
+  raise Exception('expected %s'%(exception_type.__name__,))
+
+def dirport_checks(server, address):
+  port = server.server_address[1]
+  checks = []
+
+  def download(mode, max_time=5.0):
+    server.mode = mode
+    return ufd.download_consensus_valid_until(address, port, max_time)
+
+  for mode in ['deflate', 'gzip', 'identity']:
+    def check_valid_until(mode=mode):
+      valid_until = download(mode)
+      if valid_until != server.valid_until:
+        raise Exception('got valid-until %s, expected %s'%
+                        (valid_until, server.valid_until))
+    checks.append(('%s %s consensus'%(address, mode), check_valid_until))
+
+  for mode in ['truncated', 'not-consensus', '404']:
+    def check_invalid(mode=mode):
+      expect_exception(Exception, download, mode)
+    checks.append(('%s %s response fails'%(address, mode), check_invalid))
+
+  def check_slow():
+    start = time.time()
+    expect_exception(ufd.ConsensusDownloadTimeout, download, 'slow',
+                     SLOW_MAX_TIME)
+    elapsed = time.time() - start
+    if elapsed > SLOW_MAX_TIME + 0.5:
+      raise Exception('took %0.2fs to time out'%(elapsed,))
+  checks.append(('%s slow response times out'%(address,), check_slow))
+
+  def check_candidate():
+    server.mode = 'deflate'
+    if ufd.Candidate.fallback_consensus_download_speed(address, port, 'nick',
+                                                       'FINGERPRINT', 5.0):
+      raise Exception('download check failed')
+    server.mode = 'slow'
+    if not ufd.Candidate.fallback_consensus_download_speed(address, port,
+                                                           'nick',
+                                                           'FINGERPRINT',
+                                                           SLOW_MAX_TIME):
+      raise Exception('slow download check passed')
+  checks.append(('%s Candidate download check'%(address,), check_candidate))
+  return checks
+
+# a random JSON value, nested at most a few levels deep
+def random_json_value(rnd, depth=0):
+  r = rnd.random()
+  if depth > 2 or r < 0.4:
+    return rnd.choice([0, 1, -7, 123456789012, 2.5, -1.25e-10, 1e300, True,
+                       False, None, '', 'abc', u'sné "q" \\ \n',
+                       'x' * rnd.randrange(200)])
+  if r < 0.7:
+    return [random_json_value(rnd, depth + 1)
+            for _ in range(rnd.randrange(5))]
+  return dict(('k%d'%(i,), random_json_value(rnd, depth + 1))
+              for i in range(rnd.randrange(5)))
+
+# a file-like object that returns at most chunk_size bytes from each read()
+class ChunkedReader(object):
+  def __init__(self, text, chunk_size):
+    self.text = text
+    self.pos = 0
+    self.chunk_size = chunk_size
+
+  def read(self, size):
+    size = min(size, self.chunk_size)
+    data = self.text[self.pos:self.pos + size]
+    self.pos += len(data)
+    return data
+
+def parse_relays(text, chunk_size):
+  header = {}
+  relays = list(ufd.iter_json_array_items(ChunkedReader(text, chunk_size),
+                                          'relays', header))
+  return (relays, header)
+
+def json_checks():
+  checks = []
+  rnd = random.Random(0)
+  doc = {'version': '3.1',
+         'relays_published': '2017-02-20 11:00:00',
+         'relays': [random_json_value(rnd) for _ in range(300)],
+         'bridges': [],
+         'nested': {'relays': [1, 2]}}
+  expected_header = dict((k, v) for (k, v) in doc.iteritems()
+                         if k != 'relays')
+  expected = json.loads(json.dumps(doc))
+
+  for indent in [None, 1]:
+    text = json.dumps(doc, indent=indent)
+    for chunk_size in [1, 2, 3, 7, 64, ufd.JSON_READ_SIZE]:
+      def check_document(text=text, chunk_size=chunk_size):
+        (relays, header) = parse_relays(text, chunk_size)
+        if relays != expected['relays']:
+          raise Exception('relays differ from json.loads')
+        if header != expected_header:
+          raise Exception('other members differ from json.loads')
+      checks.append(('JSON document, indent %s, %d-byte chunks'%
+                     (indent, chunk_size), check_document))
+
+  # every way of splitting a document in two, including in the middle of
+  # numbers, strings, and literals
+  text = ' { "a" : -12.5e3, "relays" : [ 123456789 , 1.5e10, "x\\"y", ' + \
+         'true, null, [], {} ] , "version" : 12 } '
+  def check_splits():
+    for split in range(1, len(text)):
+      (relays, header) = parse_relays(text, split)
+      if relays != [123456789, 1.5e10, 'x"y', True, None, [], {}]:
+        raise Exception('wrong relays with %d-byte chunks'%(split,))
+      if header != {'a': -12.5e3, 'version': 12}:
+        raise Exception('wrong members with %d-byte chunks'%(split,))
+  checks.append(('JSON document split at every offset', check_splits))
+
+  for bad in ['', '[1]', '{}', '{"relays":[1,2}', '{"relays":[1,2]',
+              '{"relays":[1 2]}', '{1:[]}']:
+    def check_bad(bad=bad):
+      for chunk_size in [1, ufd.JSON_READ_SIZE]:
+        expect_exception(Exception, parse_relays, bad, chunk_size)
+    checks.append(('bad JSON document %r fails'%(bad,), check_bad))
+  return checks
+
+def main():
+  checks = []
+  servers = [DirPortServer(('127.0.0.1', 0))]
+  if socket.has_ipv6:
+    try:
+      servers.append(DirPortServer(('::1', 0), socket.AF_INET6))
+    except socket.error:
+      print 'skipping IPv6 DirPort checks: can\'t listen on ::1'
+  for server in servers:
+    server.start()
+    if server.address_family == socket.AF_INET6:
+      address = '[::1]'
+    else:
+      address = '127.0.0.1'
+    checks += dirport_checks(server, address)
+  checks += json_checks()
+
+  failures = 0
+  for (desc, check) in checks:
+    if not run_check(desc, check):
+      failures += 1
+  for server in servers:
+    server.shutdown()
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
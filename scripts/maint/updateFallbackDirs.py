@@ -10,7 +10,6 @@
 # PERFORM_IPV4_DIRPORT_CHECKS and PERFORM_IPV6_DIRPORT_CHECKS
 #
 # Needs dateutil (and potentially other python packages)
-# Needs stem available in your PYTHONPATH, or just ln -s ../stem/stem .
 # Optionally uses ipaddress (python 3 builtin) or py2-ipaddress (package)
 # for netblock analysis, in PYTHONPATH, or just
 # ln -s ../py2-ipaddress-3.4.1/ipaddress.py .
@@ -23,15 +22,19 @@
 # https://trac.torproject.org/projects/tor/attachment/ticket/8374/dir_list.2.py
 # Modifications by teor, 2015
 
-import StringIO
 import string
 import re
 import datetime
 import gzip
+import marshal
+import socket
+import time
+import zlib
 import os.path
 import json
 import math
 import sys
+import threading
 import urllib
 import urllib2
 import hashlib
@@ -41,9 +44,6 @@ import dateutil.parser
 import copy
 import re
 
-from stem.descriptor import DocumentHandler
-from stem.descriptor.remote import get_consensus
-
 import logging
 logging.root.name = ''
 
@@ -122,6 +122,14 @@ ONIONOO = 'https://onionoo.torproject.org/'
 # even if they're very old
 LOCAL_FILES_ONLY = False
 
+# Keep a snapshot of the fields we use from each onionoo document, so that
+# re-running the script doesn't need to parse the document again
+# Increment the version whenever the snapshot contents change
+ONIONOO_SNAPSHOT_VERSION = 1
+
+# The uptime flags we use from the uptime document
+ONIONOO_SNAPSHOT_UPTIME_FLAGS = ['Running', 'Guard', 'V2Dir', 'BadExit']
+
 ## Whitelist / Blacklist Filter Settings
 
 # The whitelist contains entries that are included if all attributes match
@@ -225,6 +233,16 @@ CONSENSUS_DOWNLOAD_SPEED_MAX = 15.0
 # If the relay fails a consensus check, retry the download
 # This avoids delisting a relay due to transient network conditions
 CONSENSUS_DOWNLOAD_RETRY = True
+# How many consensus download checks can be in progress at the same time?
+# Each check can take up to CONSENSUS_DOWNLOAD_SPEED_MAX seconds, so checking
+# hundreds of candidates one at a time takes hours.
+# But every check shares this machine's bandwidth, so too many simultaneous
+# checks can make fast relays look slow. A few consensuses at a time don't
+# come close to saturating a typical connection. Set this to 1 to check
+# candidates one at a time.
+# Retries (see CONSENSUS_DOWNLOAD_RETRY) are always checked one at a time, so
+# that no relay is dropped just because it was checked alongside others.
+CONSENSUS_DOWNLOAD_CONCURRENCY = 4
 
 ## Fallback Weights for Client Selection
 
@@ -376,20 +394,31 @@ def parse_fallback_file(file_name):
   file_data = file_data.replace(' weight=10', '')
   return file_data
 
-def load_possibly_compressed_response_json(response):
-    if response.info().get('Content-Encoding') == 'gzip':
-      buf = StringIO.StringIO( response.read() )
-      f = gzip.GzipFile(fileobj=buf)
-      return json.load(f)
-    else:
-      return json.load(response)
-
-def load_json_from_file(json_file_name):
+# The number of bytes we read at a time when streaming onionoo documents
+JSON_READ_SIZE = 64 * 1024
+
+# write the body of response to file_name, exactly as we receive it
+# we write to a temporary file first, so that an interrupted download doesn't
+# leave a truncated document behind
+def save_response(response, file_name):
+  tmp_file_name = file_name + '.tmp'
+  with open(tmp_file_name, 'wb') as f:
+    while True:
+      data = response.read(JSON_READ_SIZE)
+      if not data:
+        break
+      f.write(data)
+  os.rename(tmp_file_name, file_name)
+
+def remove_file_if_exists(file_name):
+  if os.path.exists(file_name):
+    os.remove(file_name)
+
+def open_json_file(json_file_name):
     # An exception here may be resolved by deleting the .last_modified
     # and .json files, and re-running the script
     try:
-      with open(json_file_name, 'r') as f:
-        return json.load(f)
+      return open(json_file_name, 'r')
     except EnvironmentError, error:
       raise Exception('Reading not-modified json file %s failed: %d: %s'%
                     (json_file_name,
@@ -397,6 +426,99 @@ def load_json_from_file(json_file_name):
                      error.strerror)
                     )
 
+# Reads JSON values from a file one at a time, so that we never need to hold
+# a whole (large) document in memory
+class JSONStreamReader(object):
+  WHITESPACE = re.compile(r'[ \t\n\r]*')
+  NUMBER_CHARS = '0123456789+-.eE'
+
+  def __init__(self, file_obj):
+    self.file_obj = file_obj
+    self.decoder = json.JSONDecoder()
+    # the unparsed part of the document is self.buf[self.pos:]
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  # read some more of the file into the buffer, dropping the part we've
+  # already parsed
+  def _read(self):
+    data = self.file_obj.read(JSON_READ_SIZE)
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    if not data:
+      self.eof = True
+
+  # skip whitespace, and return the next character, or '' at the end of the
+  # file
+  def peek(self):
+    while True:
+      self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if self.eof:
+        return ''
+      self._read()
+
+  # skip whitespace, and return the next character, raising an Exception if
+  # it isn't one of chars
+  def expect(self, chars):
+    c = self.peek()
+    if c == '' or c not in chars:
+      raise Exception('Bad JSON document: expected one of "%s", found "%s"'%
+                      (chars, c))
+    self.pos += 1
+    return c
+
+  # parse and return the next value in the document
+  def value(self):
+    self.peek()
+    while True:
+      try:
+        (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+        # a number could continue in the part we haven't read yet
+        if self.eof or (end < len(self.buf) and
+                        self.buf[end] not in self.NUMBER_CHARS):
+          self.pos = end
+          return value
+      except ValueError:
+        # the value could continue in the part we haven't read yet
+        if self.eof:
+          raise
+      self._read()
+
+# parse the JSON object in file_obj, yielding each item in its array_key array
+# as soon as we've read it, and putting its other members in header
+# raises Exception if the document isn't an object with an array_key array
+def iter_json_array_items(file_obj, array_key, header):
+  reader = JSONStreamReader(file_obj)
+  found_array = False
+  reader.expect('{')
+  if reader.peek() == '}':
+    reader.expect('}')
+  else:
+    while True:
+      key = reader.value()
+      if not isinstance(key, basestring):
+        raise Exception('Bad JSON document: object key is not a string')
+      reader.expect(':')
+      if key == array_key:
+        found_array = True
+        reader.expect('[')
+        if reader.peek() == ']':
+          reader.expect(']')
+        else:
+          while True:
+            yield reader.value()
+            if reader.expect(',]') == ']':
+              break
+      else:
+        header[key] = reader.value()
+      if reader.expect(',}') == '}':
+        break
+  if not found_array:
+    raise Exception("No %s found in document."%(array_key,))
+
 ## OnionOO Functions
 
 def datestr_to_datetime(datestr):
@@ -430,10 +552,12 @@ def onionoo_fetch(what, **kwargs):
   MAX_LAST_MODIFIED_LENGTH = 64
 
   json_file_name = base_file_name + '.json'
+  gzip_file_name = base_file_name + '.json.gz'
+  snapshot_file_name = base_file_name + '.snapshot'
 
   if LOCAL_FILES_ONLY:
     # Read from the local file, don't write to anything
-    response_json = load_json_from_file(json_file_name)
+    pass
   else:
     # store the full URL to a file for debugging
     # no need to compare as long as you trust SHA-1
@@ -486,11 +610,15 @@ def onionoo_fetch(what, **kwargs):
     # Process the data
     if response_code == 200: # OK
 
-      response_json = load_possibly_compressed_response_json(response)
-
-      with open(json_file_name, 'w') as f:
-        # use the most compact json representation to save space
-        json.dump(response_json, f, separators=(',',':'))
+      # store the document as we receive it, without decompressing or
+      # decoding it, and get rid of the last document we stored
+      if response.info().get('Content-Encoding') == 'gzip':
+        save_response(response, gzip_file_name)
+        remove_file_if_exists(json_file_name)
+      else:
+        save_response(response, json_file_name)
+        remove_file_if_exists(gzip_file_name)
+      remove_file_if_exists(snapshot_file_name)
 
       # store the last modified date in its own file
       if response.info().get('Last-modified') is not None:
@@ -500,27 +628,294 @@ def onionoo_fetch(what, **kwargs):
 
     elif response_code == 304: # Not Modified
 
-      response_json = load_json_from_file(json_file_name)
+      # use the document we stored last time
+      pass
 
     else: # Unexpected HTTP response code not covered in the HTTPError above
       raise Exception("Unexpected HTTP response code to " + url + ": "
                       + str(response_code))
 
+  # the snapshot is only valid for the document we just stored
+  last_mod_date = read_from_file(last_modified_file_name,
+                                 MAX_LAST_MODIFIED_LENGTH)
+  return iter_onionoo_relays(what, url, base_file_name, last_mod_date)
+
+# open the onionoo document we stored for base_file_name, decompressing it if
+# needed
+def open_onionoo_document(base_file_name):
+  gzip_file_name = base_file_name + '.json.gz'
+  if os.path.isfile(gzip_file_name):
+    return gzip.open(gzip_file_name, 'rb')
+  return open_json_file(base_file_name + '.json')
+
+# return a copy of relay, containing only the fields we use from the onionoo
+# document 'what'
+def snapshot_relay(what, relay):
+  if what != 'uptime':
+    # we only ask for the details fields we use
+    return relay
+  snapshot = dict(relay)
+  # we don't use the overall uptime history
+  snapshot.pop('uptime', None)
+  if 'flags' in relay:
+    snapshot['flags'] = dict((f, h) for (f, h) in relay['flags'].iteritems()
+                             if f in ONIONOO_SNAPSHOT_UPTIME_FLAGS)
+  return snapshot
+
+# the first record in a snapshot file, which must match for the snapshot to
+# be used
+def snapshot_key(last_mod_date):
+  return ('snapshot', (ONIONOO_SNAPSHOT_VERSION, marshal.version,
+                       last_mod_date))
+
+# yield each relay in the onionoo document stored for base_file_name, one at
+# a time, then register the document's source metadata
+# if we have a snapshot for last_mod_date, read the relays from it instead of
+# the document, otherwise write a new snapshot as we parse the document
+def iter_onionoo_relays(what, url, base_file_name, last_mod_date):
+  header = {}
+  snapshot_file_name = base_file_name + '.snapshot'
+  if (last_mod_date is not None and
+      read_snapshot_key(snapshot_file_name) == snapshot_key(last_mod_date)):
+    logging.debug('Using %s snapshot %s.'%(what, snapshot_file_name))
+    relays = iter_snapshot_relays(snapshot_file_name, header)
+  elif last_mod_date is not None and not LOCAL_FILES_ONLY:
+    relays = iter_document_relays_with_snapshot(what, base_file_name,
+                                                snapshot_file_name,
+                                                last_mod_date, header)
+  else:
+    relays = iter_document_relays(what, base_file_name, header)
+  for relay in relays:
+    yield relay
   register_fetch_source(what,
                         url,
-                        response_json['relays_published'],
-                        response_json['version'])
+                        header['relays_published'],
+                        header['version'])
+
+def iter_document_relays(what, base_file_name, header):
+  with open_onionoo_document(base_file_name) as f:
+    for relay in iter_json_array_items(f, 'relays', header):
+      yield snapshot_relay(what, relay)
+
+# parse the stored document, writing each relay to a new snapshot as we go
+def iter_document_relays_with_snapshot(what, base_file_name,
+                                       snapshot_file_name, last_mod_date,
+                                       header):
+  tmp_file_name = snapshot_file_name + '.tmp'
+  complete = False
+  try:
+    with open(tmp_file_name, 'wb') as s:
+      marshal.dump(snapshot_key(last_mod_date), s)
+      for relay in iter_document_relays(what, base_file_name, header):
+        marshal.dump(('relay', relay), s)
+        yield relay
+      source = { 'relays_published': header['relays_published'],
+                 'version': header['version'] }
+      marshal.dump(('source', source), s)
+    os.rename(tmp_file_name, snapshot_file_name)
+    complete = True
+  finally:
+    # don't leave a partial snapshot behind if we stopped early
+    if not complete:
+      remove_file_if_exists(tmp_file_name)
+
+# return the first record in snapshot_file_name, or None if we can't read it
+def read_snapshot_key(snapshot_file_name):
+  try:
+    with open(snapshot_file_name, 'rb') as s:
+      return marshal.load(s)
+  except (EnvironmentError, EOFError, ValueError, TypeError):
+    return None
 
-  return response_json
+def iter_snapshot_relays(snapshot_file_name, header):
+  # An exception here may be resolved by deleting the .snapshot file, and
+  # re-running the script
+  try:
+    with open(snapshot_file_name, 'rb') as s:
+      # skip the key, we've already checked it
+      marshal.load(s)
+      while True:
+        (kind, value) = marshal.load(s)
+        if kind == 'relay':
+          yield value
+        elif kind == 'source':
+          header.update(value)
+          return
+  except (EnvironmentError, EOFError, ValueError, TypeError), error:
+    raise Exception('Reading snapshot file %s failed: %s'%
+                    (snapshot_file_name, error))
 
+# download the onionoo document 'what' (if needed), and return an iterator
+# over its relays
 def fetch(what, **kwargs):
   #x = onionoo_fetch(what, **kwargs)
   # don't use sort_keys, as the order of or_addresses is significant
-  #print json.dumps(x, indent=4, separators=(',', ': '))
+  #print json.dumps(list(x), indent=4, separators=(',', ': '))
   #sys.exit(0)
 
   return onionoo_fetch(what, **kwargs)
 
+# fetch 'what' in a separate thread, so that we can download several onionoo
+# documents at the same time
+# call start(), then result() to wait for the download, and get an iterator
+# over the document's relays
+# only the download overlaps: the relays are parsed by whoever iterates over
+# the result
+class BackgroundFetch(threading.Thread):
+  def __init__(self, what, **kwargs):
+    threading.Thread.__init__(self, name='fetch-' + what)
+    self.daemon = True
+    self.what = what
+    self.kwargs = kwargs
+    self.relays = None
+    self.exc_info = None
+
+  def run(self):
+    try:
+      self.relays = fetch(self.what, **self.kwargs)
+    except BaseException:
+      self.exc_info = sys.exc_info()
+
+  # wait for the fetch to finish, and return the iterator over its relays
+  # re-raises any exception from the fetch in the calling thread
+  def result(self):
+    # use a timeout, so that python 2 can still be interrupted
+    while self.is_alive():
+      self.join(1.0)
+    if self.exc_info is not None:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+    return self.relays
+
+## DirPort Consensus Download Functions
+
+# The maximum number of bytes we read from a DirPort in one go
+DIRPORT_READ_SIZE = 64 * 1024
+# The maximum size of the HTTP response headers we accept from a DirPort
+DIRPORT_MAX_HEADER_SIZE = 64 * 1024
+# The number of bytes at the end of the consensus we keep, so that we can
+# check that we got all of it
+CONSENSUS_TAIL_SIZE = 1024
+
+class ConsensusDownloadTimeout(Exception):
+  pass
+
+# the DirPort path of the consensus flavour we check
+def consensus_download_path():
+  if DOWNLOAD_MICRODESC_CONSENSUS:
+    return '/tor/status-vote/current/consensus-microdesc.z'
+  else:
+    return '/tor/status-vote/current/consensus.z'
+
+# read up to DIRPORT_READ_SIZE bytes from sock, waiting no later than
+# deadline (a time.time() value)
+# returns '' at the end of the response
+def recv_before_deadline(sock, deadline):
+  remaining = deadline - time.time()
+  if remaining <= 0:
+    raise ConsensusDownloadTimeout('deadline passed')
+  sock.settimeout(remaining)
+  try:
+    return sock.recv(DIRPORT_READ_SIZE)
+  except socket.timeout:
+    raise ConsensusDownloadTimeout('deadline passed')
+
+# download the consensus from address:port over HTTP, and return its
+# valid-until time as a datetime
+# rather than keeping and parsing the whole document, we decompress it as it
+# arrives, parse the valid-until line from its header, and check that the rest
+# of it ends with a signature
+# raises ConsensusDownloadTimeout if the download takes longer than max_time
+# seconds, and Exception if the relay's response is not a consensus
+# address may be an IPv4 address, or an IPv6 address in brackets
+# any HTTP server that serves a consensus at path will do, so a local
+# stand-in can replace a real relay when testing this script
+def download_consensus_valid_until(address, port, max_time, path=None):
+  if path is None:
+    path = consensus_download_path()
+  deadline = time.time() + max_time
+  host = Candidate.strip_ipv6_brackets(address)
+  try:
+    sock = socket.create_connection((host, port), max_time)
+  except socket.timeout:
+    raise ConsensusDownloadTimeout('connection timed out')
+  try:
+    sock.sendall('GET %s HTTP/1.0\r\nHost: %s:%d\r\n\r\n'%(path,
+                                                                address, port))
+    # read the headers
+    response = ''
+    while not '\r\n\r\n' in response:
+      if len(response) > DIRPORT_MAX_HEADER_SIZE:
+        raise Exception('HTTP headers too long')
+      data = recv_before_deadline(sock, deadline)
+      if not data:
+        raise Exception('connection closed before the end of the headers')
+      response += data
+    (headers, body) = response.split('\r\n\r\n', 1)
+    header_lines = headers.split('\r\n')
+    status = header_lines[0].split(' ', 2)
+    if len(status) < 2 or status[1] != '200':
+      raise Exception('HTTP error: %s'%(cleanse_unprintable(header_lines[0])))
+    encoding = 'identity'
+    for line in header_lines[1:]:
+      if line.lower().startswith('content-encoding:'):
+        encoding = line.split(':', 1)[1].strip().lower()
+    if encoding == 'identity':
+      decompressor = None
+    elif encoding in ['deflate', 'x-zlib', 'gzip', 'x-gzip']:
+      # accept either a zlib or a gzip header
+      decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    else:
+      raise Exception('unknown Content-Encoding: %s'%
+                      (cleanse_unprintable(encoding)))
+    # read the body, keeping the start of the document until we've parsed
+    # its valid-until line, and the end of the document after that
+    text = ''
+    valid_until = None
+    while True:
+      if decompressor is not None:
+        text += decompressor.decompress(body)
+      else:
+        text += body
+      if valid_until is None and text:
+        valid_until = parse_consensus_valid_until(text)
+      if valid_until is not None:
+        text = text[-CONSENSUS_TAIL_SIZE:]
+      body = recv_before_deadline(sock, deadline)
+      if not body:
+        break
+    if decompressor is not None:
+      text += decompressor.flush()
+  finally:
+    sock.close()
+  if valid_until is None:
+    valid_until = parse_consensus_valid_until(text, True)
+  if not text.endswith('-----END SIGNATURE-----\n'):
+    raise Exception('consensus is truncated')
+  return valid_until
+
+# parse the valid-until time from the start of a consensus in text
+# returns None if we haven't got that far into the document yet, unless
+# complete is True
+# raises Exception if text isn't the start of a consensus
+def parse_consensus_valid_until(text, complete=False):
+  if not (text.startswith('network-status-version 3')
+          or 'network-status-version 3'.startswith(text)):
+    raise Exception('not a v3 consensus')
+  lines = text.split('\n')
+  if not complete:
+    # the last line might not have arrived in full
+    lines = lines[:-1]
+  for line in lines:
+    if line.startswith('valid-until '):
+      return parse_ts(line[len('valid-until '):])
+    if line.startswith('dir-source ') or line.startswith('r '):
+      # valid-until is in the preamble, and we're past it
+      break
+  else:
+    if not complete:
+      return None
+  raise Exception('consensus has no valid-until line')
+
 ## Fallback Candidate Class
 
 class Candidate(object):
@@ -1172,39 +1567,33 @@ class Candidate(object):
   def fallback_consensus_download_speed(dirip, dirport, nickname, fingerprint,
                                         max_time):
     download_failed = False
+    download_timed_out = False
     # some directory mirrors respond to requests in ways that hang python
     # sockets, which is why we log this line here
     logging.info('Initiating %sconsensus download from %s (%s:%d) %s.',
                  'microdesc ' if DOWNLOAD_MICRODESC_CONSENSUS else '',
                  nickname, dirip, dirport, fingerprint)
-    # there appears to be about 1 second of overhead when comparing stem's
-    # internal trace time and the elapsed time calculated here
-    TIMEOUT_SLOP = 1.0
     start = datetime.datetime.utcnow()
     try:
-      consensus = get_consensus(
-                              endpoints = [(dirip, dirport)],
-                              timeout = (max_time + TIMEOUT_SLOP),
-                              validate = True,
-                              retries = 0,
-                              fall_back_to_authority = False,
-                              document_handler = DocumentHandler.BARE_DOCUMENT,
-                              microdescriptor = DOWNLOAD_MICRODESC_CONSENSUS
-                                ).run()[0]
+      valid_until = download_consensus_valid_until(dirip, dirport, max_time)
       end = datetime.datetime.utcnow()
-      time_since_expiry = (end - consensus.valid_until).total_seconds()
-    except Exception, stem_error:
+      time_since_expiry = (end - valid_until).total_seconds()
+    except ConsensusDownloadTimeout:
+      end = datetime.datetime.utcnow()
+      # this is reported as too slow below
+      download_timed_out = True
+    except Exception, download_error:
       end = datetime.datetime.utcnow()
       log_excluded('Unable to retrieve a consensus from %s: %s', nickname,
-                    stem_error)
-      status = 'error: "%s"' % (stem_error)
+                    download_error)
+      status = 'error: "%s"' % (download_error)
       level = logging.WARNING
       download_failed = True
     elapsed = (end - start).total_seconds()
     if download_failed:
       # keep the error failure status, and avoid using the variables
       pass
-    elif elapsed > max_time:
+    elif download_timed_out or elapsed > max_time:
       status = 'too slow'
       level = logging.WARNING
       download_failed = True
@@ -1384,28 +1773,36 @@ class CandidateList(dict):
 
   def _add_details(self):
     logging.debug('Loading details document.')
-    d = fetch('details',
+    relays = fetch('details',
         fields=('fingerprint,nickname,contact,last_changed_address_or_port,' +
                 'consensus_weight,advertised_bandwidth,or_addresses,' +
                 'dir_address,recommended_version,flags,effective_family,' +
                 'platform'))
-    logging.debug('Loading details document done.')
 
-    if not 'relays' in d: raise Exception("No relays found in document.")
-
-    for r in d['relays']: self._add_relay(r)
+    # add each relay as soon as it's parsed
+    for r in relays: self._add_relay(r)
+    logging.debug('Loading details document done.')
 
-  def _add_uptimes(self):
+  # if uptime_fetch is a started BackgroundFetch for the uptime document,
+  # use its result, otherwise fetch the document now
+  def _add_uptimes(self, uptime_fetch=None):
     logging.debug('Loading uptime document.')
-    d = fetch('uptime')
-    logging.debug('Loading uptime document done.')
+    if uptime_fetch is not None:
+      relays = uptime_fetch.result()
+    else:
+      relays = fetch('uptime')
 
-    if not 'relays' in d: raise Exception("No relays found in document.")
-    for r in d['relays']: self._add_uptime(r)
+    # each relay's uptime history is averaged, then discarded
+    for r in relays: self._add_uptime(r)
+    logging.debug('Loading uptime document done.')
 
   def add_relays(self):
+    # download the uptime document while we're working on the details
+    # document, then add the uptimes once we have both
+    uptime_fetch = BackgroundFetch('uptime')
+    uptime_fetch.start()
     self._add_details()
-    self._add_uptimes()
+    self._add_uptimes(uptime_fetch)
 
   def count_guards(self):
     guard_count = 0
@@ -1736,19 +2133,62 @@ class CandidateList(dict):
     self.fallbacks = family_limit_fallbacks
     return original_count - len(self.fallbacks)
 
-  # try a download check on each fallback candidate in order
-  # stop after max_count successful downloads
+  # try a download check on each fallback candidate in order, with up to
+  # concurrency (default CONSENSUS_DOWNLOAD_CONCURRENCY) checks in progress at
+  # the same time
+  # stop starting checks after max_count successful downloads
   # but don't remove any candidates from the array
-  def try_download_consensus_checks(self, max_count):
-    dl_ok_count = 0
-    for f in self.fallbacks:
-      f.try_fallback_download_consensus()
-      if f.get_fallback_download_consensus():
-        # this fallback downloaded a consensus ok
-        dl_ok_count += 1
-        if dl_ok_count >= max_count:
+  # Checks that are already in progress when we reach max_count are allowed to
+  # finish. So we might check a few more candidates than a serial check would,
+  # but the first max_count successful candidates (in array order) are the
+  # same.
+  def try_download_consensus_checks(self, max_count, concurrency=None):
+    if concurrency is None:
+      concurrency = CONSENSUS_DOWNLOAD_CONCURRENCY
+    # the number of successful downloads, and the number of checks in progress
+    # guarded by done, which is notified each time a check finishes
+    state = {'dl_ok_count': 0, 'running_count': 0}
+    done = threading.Condition()
+
+    def run_check(f):
+      try:
+        f.try_fallback_download_consensus()
+      except BaseException as e:
+        logging.warning('Exception %s when checking consensus download for ' +
+                        '%s', str(e), f._fpr)
+        f._data['download_check'] = False
+      finally:
+        with done:
+          if f.get_fallback_download_consensus():
+            state['dl_ok_count'] += 1
+          state['running_count'] -= 1
+          done.notify()
+
+    def wait_for_check():
+      # use a timeout, so that python 2 can still be interrupted
+      done.wait(1.0)
+
+    with done:
+      for f in self.fallbacks:
+        if f.get_fallback_download_consensus():
+          # this fallback already downloaded a consensus ok
+          state['dl_ok_count'] += 1
+        else:
+          while (state['running_count'] >= concurrency
+                 and state['dl_ok_count'] < max_count):
+            wait_for_check()
+        if state['dl_ok_count'] >= max_count:
           # we have enough fallbacks
-          return
+          break
+        if f.get_fallback_download_consensus():
+          continue
+        state['running_count'] += 1
+        check = threading.Thread(target=run_check, args=(f,))
+        check.daemon = True
+        check.start()
+      # let the checks in progress finish
+      while state['running_count'] > 0:
+        wait_for_check()
 
   # put max_count successful candidates in the fallbacks array:
   # - perform download checks on each fallback candidate
@@ -1761,9 +2201,10 @@ class CandidateList(dict):
     self.sort_fallbacks_by_measured_bandwidth()
     self.try_download_consensus_checks(max_count)
     if CONSENSUS_DOWNLOAD_RETRY:
-      # try unsuccessful candidates again
+      # try unsuccessful candidates again, one at a time, so that contention
+      # between checks can't make them fail twice
       # we could end up with more than max_count successful candidates here
-      self.try_download_consensus_checks(max_count)
+      self.try_download_consensus_checks(max_count, concurrency=1)
     # now we have at least max_count successful candidates,
     # or we've tried them all
     original_count = len(self.fallbacks)
@@ -2075,7 +2516,6 @@ class CandidateList(dict):
 
 def process_existing():
   logging.basicConfig(level=logging.INFO)
-  logging.getLogger('stem').setLevel(logging.INFO)
   whitelist = {'data': parse_fallback_file(FALLBACK_FILE_NAME),
                'name': FALLBACK_FILE_NAME}
   blacklist = {'data': read_from_file(BLACKLIST_FILE_NAME, MAX_LIST_FILE_SIZE),
@@ -2084,7 +2524,6 @@ def process_existing():
 
 def process_default():
   logging.basicConfig(level=logging.WARNING)
-  logging.getLogger('stem').setLevel(logging.WARNING)
   whitelist = {'data': read_from_file(WHITELIST_FILE_NAME, MAX_LIST_FILE_SIZE),
                'name': WHITELIST_FILE_NAME}
   blacklist = {'data': read_from_file(BLACKLIST_FILE_NAME, MAX_LIST_FILE_SIZE),
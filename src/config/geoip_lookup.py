@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+
+#   This software has been dedicated to the public domain under the CC0
+#   public domain dedication.
+#
+#   To the extent possible under law, the person who associated CC0
+#   with geoip_lookup.py has waived all copyright and related or
+#   neighboring rights to geoip_lookup.py.
+#
+#   You should have received a copy of the CC0 legalcode along with this
+#   work in doc/cc0.txt.  If not, see
+#      <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Look up the countries of IP addresses in Tor's geoip and geoip6 files.
+
+   Parsing the text files takes a while, so the first time we load one, we
+   convert it to the binary format that mmdb-convert.py writes with
+   --binary, and keep that in a cache directory.  After that, loading the
+   file is just an mmap of the cached copy.
+
+   Single lookups binary-search the mmap'd range starts in place.  Batch
+   lookups use numpy's searchsorted if numpy is installed, and fall back to
+   one binary search per address if it isn't.
+
+   Example:
+
+       db = geoip_lookup.GeoIPDatabase('src/config/geoip',
+                                        'src/config/geoip6')
+       db.lookup('128.31.0.34')
+       db.lookup_many(['128.31.0.34', '2001:858:2:2:aabb:0:563b:1526'])
+
+   Addresses that aren't in any range have a country of None.
+"""
+
+import bisect
+import hashlib
+import importlib.util
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def load_converter():
+    """Import mmdb-convert.py, which lives next to this module, and return
+       it as a module.  mmdb-bench.py loads it through here as well."""
+    try:
+        return sys.modules['mmdb_convert']
+    except KeyError:
+        pass
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'mmdb-convert.py')
+    spec = importlib.util.spec_from_file_location('mmdb_convert', path)
+    module = importlib.util.module_from_spec(spec)
+    # Register the module, so that worker processes can find the
+    # functions we hand them.
+    sys.modules['mmdb_convert'] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        del sys.modules['mmdb_convert']
+        raise
+    return module
+
+mmdb_convert = load_converter()
+
+def default_cache_dir():
+    "Return the directory where we cache binary copies of geoip files."
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'tor-geoip')
+
+def cached_binary_file(filename, addr_bytes, cache_dir=None):
+    """Return the name of a binary copy of the geoip (or geoip6) file
+       called filename, creating it if we don't have an up-to-date one.
+       The cache is keyed by the file's path, size and modification
+       time."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    st = os.stat(filename)
+    path_key = hashlib.sha1(os.path.abspath(filename).encode('utf8'))
+    stat_key = "%d-%d" % (st.st_size, st.st_mtime_ns)
+    prefix = "%s.%s." % (os.path.basename(filename),
+                         path_key.hexdigest()[:16])
+    cached = os.path.join(cache_dir, prefix + stat_key + ".bin")
+    if os.path.exists(cached):
+        return cached
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if addr_bytes == 4:
+        parse_addr = int
+    else:
+        parse_addr = mmdb_convert.parse_ipv6_addr
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=prefix, suffix='.tmp')
+    os.close(fd)
+    try:
+        mmdb_convert.write_geoip_binary(
+            tmp, mmdb_convert.read_geoip_file(filename, parse_addr),
+            addr_bytes)
+        os.rename(tmp, cached)
+    except:
+        os.remove(tmp)
+        raise
+
+    # Throw away the copies of older versions of this file.
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith('.bin') and \
+           name != os.path.basename(cached):
+            os.remove(os.path.join(cache_dir, name))
+    return cached
+
+class FixedWidthSequence(object):
+    """A read-only sequence of the fixed-width byte strings held in
+       buf[offset:offset+count*width], so that bisect can search them
+       without copying them out first."""
+    def __init__(self, buf, offset, width, count):
+        self.buf = buf
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        p = self.offset + i * self.width
+        return self.buf[p:p+self.width]
+
+class GeoIPTable(object):
+    """The ranges of one address family, from a file in the binary geoip
+       format, which we mmap."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_len = struct.calcsize(mmdb_convert.GEOIP_BINARY_HEADER)
+        magic, version, addr_bytes, n_countries, n_ranges = struct.unpack(
+            mmdb_convert.GEOIP_BINARY_HEADER, self.buf[:header_len])
+        if magic != mmdb_convert.GEOIP_BINARY_MAGIC or \
+           version != mmdb_convert.GEOIP_BINARY_VERSION:
+            raise ValueError("%s is not a binary geoip file" % filename)
+        p = header_len + n_countries * 2
+        if len(self.buf) != p + n_ranges * (addr_bytes + 2):
+            raise ValueError("%s is truncated" % filename)
+
+        self.addr_bytes = addr_bytes
+        self.countries = [self.buf[i:i+2].decode('ascii')
+                          for i in range(header_len, p, 2)]
+        self.countries.append(None)
+        self.starts = FixedWidthSequence(self.buf, p, addr_bytes, n_ranges)
+        self.index_offset = p + n_ranges * addr_bytes
+
+        if numpy is not None:
+            if addr_bytes == 4:
+                dtype = '>u4'
+            else:
+                dtype = 'S%d' % addr_bytes
+            self.np_starts = numpy.frombuffer(self.buf, dtype, n_ranges, p)
+            self.np_indices = numpy.frombuffer(self.buf, '>u2', n_ranges,
+                                               self.index_offset)
+            # Map GEOIP_BINARY_NO_COUNTRY onto the None at the end of
+            # countries.
+            self.np_indices = numpy.minimum(self.np_indices,
+                                            n_countries)
+            self.np_countries = numpy.array(self.countries, dtype=object)
+
+    def country_at(self, i):
+        "Return the country of the i'th range."
+        p = self.index_offset + i * 2
+        index = struct.unpack("!H", self.buf[p:p+2])[0]
+        if index == mmdb_convert.GEOIP_BINARY_NO_COUNTRY:
+            return None
+        return self.countries[index]
+
+    def lookup(self, addr):
+        "Return the country of the address addr, an integer."
+        key = mmdb_convert.addr_to_bytes(addr, self.addr_bytes)
+        return self.country_at(bisect.bisect_right(self.starts, key) - 1)
+
+    def lookup_many(self, addrs):
+        """Return a list of the countries of the addresses in addrs, a
+           sequence of integers."""
+        if numpy is None:
+            return [self.lookup(addr) for addr in addrs]
+        if self.addr_bytes == 4:
+            keys = numpy.asarray(addrs, dtype='>u4')
+        else:
+            keys = numpy.array([mmdb_convert.addr_to_bytes(addr, 16)
+                                for addr in addrs], dtype='S16')
+        positions = numpy.searchsorted(self.np_starts, keys, 'right') - 1
+        return list(self.np_countries[self.np_indices[positions]])
+
+def parse_addr(address):
+    """Given the string for an IPv4 or IPv6 address, return a pair of the
+       address family (4 or 6) and the address as an integer.  IPv4-mapped
+       IPv6 addresses are treated as IPv4 addresses."""
+    if ':' not in address:
+        return 4, struct.unpack("!L", socket.inet_aton(address))[0]
+    v = mmdb_convert.parse_ipv6_addr(address)
+    if v >> 32 == 0xffff:
+        return 4, v & 0xffffffff
+    return 6, v
+
+class GeoIPDatabase(object):
+    """Country lookups for IPv4 and IPv6 addresses, from a geoip and a
+       geoip6 file.  Either file may be None, in which case addresses in
+       its family don't belong to any country."""
+    def __init__(self, geoip_filename=None, geoip6_filename=None,
+                 cache_dir=None):
+        self.tables = {}
+        for family, filename, addr_bytes in ((4, geoip_filename, 4),
+                                             (6, geoip6_filename, 16)):
+            if filename is not None:
+                self.tables[family] = GeoIPTable(
+                    cached_binary_file(filename, addr_bytes, cache_dir))
+
+    def lookup(self, address):
+        "Return the country of the IPv4 or IPv6 address string 'address'."
+        family, addr = parse_addr(address)
+        if family not in self.tables:
+            return None
+        return self.tables[family].lookup(addr)
+
+    def lookup_many(self, addresses):
+        """Return a list of the countries of the IPv4 and IPv6 address
+           strings in 'addresses'."""
+        result = [None] * len(addresses)
+        by_family = {4: ([], []), 6: ([], [])}
+        for i, address in enumerate(addresses):
+            family, addr = parse_addr(address)
+            by_family[family][0].append(i)
+            by_family[family][1].append(addr)
+        for family, (positions, addrs) in by_family.items():
+            if addrs and family in self.tables:
+                for i, country in zip(positions,
+                                      self.tables[family].lookup_many(addrs)):
+                    result[i] = country
+        return result
+
+def main(args):
+    """Look up the addresses in args, or on stdin if there are none, and
+       print their countries."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    db = GeoIPDatabase(os.path.join(here, 'geoip'),
+                       os.path.join(here, 'geoip6'))
+    if not args:
+        args = [line.strip() for line in sys.stdin if line.strip()]
+    for address, country in zip(args, db.lookup_many(args)):
+        print("%s,%s" % (address, country or '??'))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,630 @@
+#!/usr/bin/python3
+
+#   This software has been dedicated to the public domain under the CC0
+#   public domain dedication.
+#
+#   To the extent possible under law, the person who associated CC0
+#   with mmdb-bench.py has waived all copyright and related or
+#   neighboring rights to mmdb-bench.py.
+#
+#   You should have received a copy of the CC0 legalcode along with this
+#   work in doc/cc0.txt.  If not, see
+#      <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Test and benchmark mmdb-convert.py without a real MaxMind database.
+
+   This script writes synthetic MaxMind-DB files, with a configurable
+   number of networks, record size and record shape, laid out the way
+   MaxMind lays out its IPv6 databases (including the IPv6 aliases of the
+   IPv4 subtree).  It has three commands:
+
+     write FILE   Write a synthetic database to FILE.
+     check        Convert a range of synthetic databases, and make sure
+                  that the geoip and geoip6 files we get back hold exactly
+                  the ranges that we put in.
+     bench        Convert a synthetic database, and report how long each
+                  phase of the conversion takes, and the peak RSS.
+
+   Like mmdb-convert.py, this only knows as much about the MaxMind-DB
+   format as it needs to.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from geoip_lookup import load_converter
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+
+TP_PTR = 1
+TP_UTF8 = 2
+TP_DBL = 3
+TP_UINT16 = 5
+TP_UINT32 = 6
+TP_MAP = 7
+TP_UINT64 = 9
+TP_ARRAY = 11
+TP_BOOL = 14
+
+def encode_type_and_len(tp, ln):
+    """Encode the control byte(s) for a value of type tp and length ln.
+       This is the inverse of mmdb-convert's get_type_and_len, except for
+       pointers."""
+    if ln < 29:
+        extra = b''
+    elif ln < 285:
+        extra = struct.pack("!B", ln - 29)
+        ln = 29
+    elif ln < 65821:
+        extra = struct.pack("!H", ln - 285)
+        ln = 30
+    else:
+        extra = struct.pack("!L", ln - 65821)[1:]
+        ln = 31
+    if tp < 8:
+        return struct.pack("!B", (tp << 5) | ln) + extra
+    else:
+        return struct.pack("!BB", ln, tp - 7) + extra
+
+def encode_pointer(pos):
+    """Encode a pointer to position pos in the data section."""
+    if pos < 2048:
+        return struct.pack("!BB", (TP_PTR << 5) | (pos >> 8), pos & 0xff)
+    pos -= 2048
+    if pos < 524288:
+        return struct.pack("!BH", (TP_PTR << 5) | 0x08 | (pos >> 16),
+                           pos & 0xffff)
+    pos -= 524288
+    if pos < (1 << 27):
+        return (struct.pack("!B", (TP_PTR << 5) | 0x10 | (pos >> 24)) +
+                struct.pack("!L", pos)[1:])
+    return struct.pack("!BL", (TP_PTR << 5) | 0x18, pos + 526336)
+
+class Double(float):
+    "A float that we should encode as a double, not a float."
+
+class DataWriter(object):
+    """Builds a data section.  If 'dedup' is true, we write each distinct
+       string and map once, and use pointers for the repeats, as MaxMind's
+       own writer does.  (The metadata section can't hold pointers.)"""
+    def __init__(self, dedup=True):
+        self.buf = bytearray()
+        self.dedup = dedup
+        self.seen = {}
+
+    def add(self, value):
+        """Append value to the data section, and return its position.  If
+           we've written value before, just return its old position: the
+           tree has to point straight at a record, not at a pointer."""
+        if self.dedup:
+            pos = self.seen.get(repr(value))
+            if pos is not None:
+                return pos
+        pos = len(self.buf)
+        self.write(value)
+        return pos
+
+    def write(self, value):
+        "Helper: append the encoding of value."
+        key = None
+        if self.dedup and isinstance(value, (str, dict)):
+            key = repr(value)
+            if key in self.seen:
+                self.buf += encode_pointer(self.seen[key])
+                return
+        pos = len(self.buf)
+
+        if isinstance(value, bool):
+            self.buf += encode_type_and_len(TP_BOOL, int(value))
+        elif isinstance(value, Double):
+            self.buf += encode_type_and_len(TP_DBL, 8)
+            self.buf += struct.pack("!d", value)
+        elif isinstance(value, int):
+            n = (value.bit_length() + 7) // 8
+            tp = TP_UINT16 if n <= 2 else TP_UINT32 if n <= 4 else TP_UINT64
+            self.buf += encode_type_and_len(tp, n)
+            self.buf += value.to_bytes(n, 'big')
+        elif isinstance(value, str):
+            b = value.encode('utf8')
+            self.buf += encode_type_and_len(TP_UTF8, len(b))
+            self.buf += b
+        elif isinstance(value, dict):
+            self.buf += encode_type_and_len(TP_MAP, len(value))
+            for k in sorted(value):
+                self.write(k)
+                self.write(value[k])
+        elif isinstance(value, list):
+            self.buf += encode_type_and_len(TP_ARRAY, len(value))
+            for v in value:
+                self.write(v)
+        else:
+            raise TypeError("Can't encode %r" % (value,))
+
+        if key is not None:
+            self.seen[key] = pos
+
+def encode_node(left, right, record_size):
+    """Encode a node of the search tree with the given left and right
+       records."""
+    if record_size == 24:
+        return struct.pack("!L", left)[1:] + struct.pack("!L", right)[1:]
+    elif record_size == 28:
+        return (struct.pack("!L", left)[1:] +
+                struct.pack("!B", ((left >> 20) & 0xf0) | (right >> 24)) +
+                struct.pack("!L", right)[1:])
+    elif record_size == 32:
+        return struct.pack("!LL", left, right)
+    else:
+        raise NotImplementedError("Unsupported record size in bits: %d" %
+                                  record_size)
+
+# IPv6 subnets that MaxMind maps onto the IPv4 subtree at ::/96, as
+# (prefix, prefix length in bits).
+IPV4_ALIASES = ((0xffff, 96), (0x2002, 16), (0x20010000, 32))
+
+class MMDBWriter(object):
+    """Builds an IPv6 MaxMind-DB file from a set of networks."""
+    def __init__(self, record_size=24, database_type='GeoLite2-Country'):
+        self.record_size = record_size
+        self.database_type = database_type
+        # Each node is a [left, right] pair.  Each record is None, ('node',
+        # index), or ('data', position in the data section).
+        self.nodes = [[None, None]]
+        self.data = DataWriter()
+        self.ipv4_root = self.find_node(0, 96)
+
+    def find_node(self, prefix, depth):
+        """Return the index of the node for the 'depth'-bit prefix 'prefix',
+           creating it and its parents if need be."""
+        node = 0
+        for i in range(depth - 1, -1, -1):
+            bit = (prefix >> i) & 1
+            record = self.nodes[node][bit]
+            if record is None:
+                self.nodes.append([None, None])
+                record = self.nodes[node][bit] = ('node', len(self.nodes) - 1)
+            elif record[0] != 'node':
+                raise ValueError("Network overlaps an existing network")
+            node = record[1]
+        return node
+
+    def insert(self, network, prefix_len, record):
+        """Map the IPv6 network with the 128-bit integer address 'network'
+           and length 'prefix_len' to 'record', a dict."""
+        prefix = network >> (128 - prefix_len)
+        node = self.find_node(prefix >> 1, prefix_len - 1)
+        if self.nodes[node][prefix & 1] is not None:
+            raise ValueError("Network overlaps an existing network")
+        self.nodes[node][prefix & 1] = ('data', self.data.add(record))
+
+    def write(self, filename, build_epoch=1487030400):
+        "Write the database to filename."
+        for prefix, prefix_len in IPV4_ALIASES:
+            node = self.find_node(prefix >> 1, prefix_len - 1)
+            self.nodes[node][prefix & 1] = ('node', self.ipv4_root)
+
+        node_count = len(self.nodes)
+        def encode_record(record):
+            "Helper: turn a record into the number we write for it."
+            if record is None:
+                return node_count
+            elif record[0] == 'node':
+                return record[1]
+            else:
+                return node_count + 16 + record[1]
+
+        metadata = DataWriter(dedup=False)
+        metadata.add({
+            'binary_format_major_version': 2,
+            'binary_format_minor_version': 0,
+            'build_epoch': build_epoch,
+            'database_type': self.database_type,
+            'description': {'en': 'Synthetic %s database' %
+                            self.database_type},
+            'ip_version': 6,
+            'languages': ['en'],
+            'node_count': node_count,
+            'record_size': self.record_size,
+        })
+
+        with open(filename, 'wb') as f:
+            f.write(b''.join(encode_node(encode_record(left),
+                                         encode_record(right),
+                                         self.record_size)
+                             for left, right in self.nodes))
+            f.write(b'\x00' * 16)
+            f.write(self.data.buf)
+            f.write(METADATA_MARKER)
+            f.write(metadata.buf)
+
+LANGUAGES = ('de', 'en', 'es', 'fr', 'ja', 'pt-BR', 'ru', 'zh-CN')
+
+SHAPES = ('minimal', 'country', 'city')
+
+def make_place(rnd, kind, name, iso_code=None):
+    "Make the map for a country, continent, or city."
+    place = {'geoname_id': rnd.randrange(1 << 24),
+             'names': dict((lang, "%s %s (%s)" % (kind, name, lang))
+                           for lang in LANGUAGES)}
+    if iso_code:
+        place['iso_code'] = iso_code
+    return place
+
+def make_records(rnd, shape, n_records, n_countries):
+    """Make a list of n_records random records with the given shape.
+       Return a list of (record, country code) pairs, where the country
+       code is the one that mmdb-convert should output for the record, or
+       None if it should output nothing."""
+    codes = ["%c%c" % (ord('A') + i // 26, ord('A') + i % 26)
+             for i in range(n_countries)]
+    continent = make_place(rnd, 'Continent', 'EU')
+    continent['code'] = 'EU'
+    result = []
+    for i in range(n_records):
+        country = rnd.choice(codes)
+        registered = rnd.choice(codes)
+        if shape == 'minimal':
+            record = {'country': {'iso_code': country}}
+        else:
+            record = {'continent': continent,
+                      'country': make_place(rnd, 'Country', country, country),
+                      'registered_country': make_place(rnd, 'Country',
+                                                       registered,
+                                                       registered)}
+        if shape == 'city':
+            record['city'] = make_place(rnd, 'City', str(i))
+            record['location'] = {'latitude': Double(rnd.uniform(-90, 90)),
+                                  'longitude': Double(rnd.uniform(-180, 180)),
+                                  'accuracy_radius': rnd.randrange(1000)}
+            record['subdivisions'] = [make_place(rnd, 'Region', str(i), 'R')]
+            record['postal'] = {'code': str(rnd.randrange(100000))}
+
+        # Anonymous proxies only have a registered country, and a few
+        # records have neither.
+        r = rnd.random()
+        if shape != 'minimal' and r < 0.05:
+            del record['country']
+            country = registered
+        elif shape != 'minimal' and r < 0.07:
+            del record['country']
+            del record['registered_country']
+            country = None
+        result.append((record, country))
+    return result
+
+def make_networks(rnd, base, base_len, bits, count):
+    """Return a list of up to 'count' non-overlapping networks, as
+       (address, prefix length) pairs, inside the 'bits'-bit network
+       base/base_len, in address order.  Most networks are adjacent to
+       the one before, so that there's something to merge."""
+    min_len = max(base_len + 1, min(bits, base_len + count.bit_length() + 2))
+    max_len = min(bits, min_len + 8)
+    end = base + (1 << (bits - base_len))
+    cursor = base
+    result = []
+    while len(result) < count:
+        prefix_len = rnd.randint(min_len, max_len)
+        size = 1 << (bits - prefix_len)
+        cursor = (cursor + size - 1) // size * size
+        if cursor + size > end:
+            break
+        result.append((cursor, prefix_len))
+        cursor += size
+        if rnd.random() < 0.1:
+            cursor += rnd.randrange(size * 4)
+    return result
+
+# Where we put synthetic IPv6 networks, as (network, prefix length).
+IPV6_BLOCKS = ((0x24 << 120, 8), (0x26 << 120, 8), (0x2a << 120, 8),
+               (0x2c << 120, 8))
+
+def build_database(filename, n_ipv4=10000, n_ipv6=2000, record_size=24,
+                   shape='country', n_records=500, n_countries=200, seed=0):
+    """Write a synthetic database to filename.  Return a pair of lists of
+       the merged (lo, hi, country code) IPv4 and IPv6 ranges that
+       mmdb-convert should output for it."""
+    rnd = random.Random(seed)
+    writer = MMDBWriter(record_size,
+                        'GeoLite2-City' if shape == 'city'
+                        else 'GeoLite2-Country')
+    records = make_records(rnd, shape, n_records, n_countries)
+
+    # IPv4 networks live in ::/96, so they're just IPv6 networks with a
+    # 96-bit prefix of zeros.
+    networks = [(network, prefix_len + 96, 0) for network, prefix_len in
+                make_networks(rnd, 0, 0, 32, n_ipv4)]
+    per_block = max(1, n_ipv6 // len(IPV6_BLOCKS))
+    for block, block_len in IPV6_BLOCKS:
+        networks.extend((network, prefix_len, 1) for network, prefix_len in
+                        make_networks(rnd, block, block_len, 128, per_block))
+
+    expected = ([], [])
+    record, code = rnd.choice(records)
+    for network, prefix_len, family in networks:
+        # Neighbouring networks often share a record.
+        if rnd.random() < 0.4:
+            record, code = rnd.choice(records)
+        writer.insert(network, prefix_len, record)
+        if code is not None:
+            hi = network + (1 << (128 - prefix_len)) - 1
+            merge_range(expected[family], (network, hi, code))
+
+    writer.write(filename)
+    return expected
+
+def merge_range(ranges, entry):
+    """Append entry to the list of ranges, merging it with the last one if
+       they're adjacent and have the same value."""
+    if ranges and ranges[-1][1] + 1 == entry[0] and ranges[-1][2] == entry[2]:
+        ranges[-1] = (ranges[-1][0], entry[1], entry[2])
+    else:
+        ranges.append(entry)
+
+def parse_ipv6(addr):
+    "Return the 128-bit integer for the IPv6 address string addr."
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, addr), 'big')
+
+def read_geoip_file(filename, parse_addr):
+    """Read a geoip or geoip6 file, and return a list of its
+       (lo, hi, country code) ranges."""
+    result = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            lo, hi, code = line.rstrip('\n').split(',')
+            result.append((parse_addr(lo), parse_addr(hi), code))
+    return result
+
+def compare_ranges(name, got, expected):
+    """Return a list of problems with the ranges we got, compared to the
+       ones we expected."""
+    if got == expected:
+        return []
+    problems = ["%s: got %d ranges, expected %d" %
+                (name, len(got), len(expected))]
+    for i, (g, e) in enumerate(zip(got, expected)):
+        if g != e:
+            problems.append("%s: first difference at range %d: got %r, "
+                            "expected %r" % (name, i, g, e))
+            break
+    return problems
+
+def convert(converter, mmdb_filename, out_dir, jobs=1, lazy=True):
+    """Convert mmdb_filename into geoip and geoip6 files in out_dir, and
+       return their names.  If 'lazy' is false, parse the whole data
+       section up front, as parse_mm_file(lazy=False) does."""
+    geoip = os.path.join(out_dir, 'geoip')
+    geoip6 = os.path.join(out_dir, 'geoip6')
+    buf = converter.open_mm_file(mmdb_filename)
+    metadata, tree, _ = converter.parse_mm_file(buf, lazy)
+    converter.write_geoip_files(geoip, geoip6, metadata, tree,
+                                mmdb_filename, jobs, mmdb_buf=buf)
+    return geoip, geoip6
+
+# The databases that 'check' round-trips, as keyword arguments for
+# build_database.
+CHECK_CASES = [
+    dict(n_ipv4=0, n_ipv6=0),
+    dict(n_ipv4=1, n_ipv6=1, n_records=1),
+    dict(n_ipv4=2000, n_ipv6=500, shape='minimal'),
+    dict(n_ipv4=2000, n_ipv6=500, shape='country'),
+    dict(n_ipv4=2000, n_ipv6=500, shape='city', n_records=2000),
+    dict(n_ipv4=20000, n_ipv6=20000, n_records=50),
+]
+
+def cmd_check(converter, options):
+    """Run the round-trip checks, with each number of jobs, and once more
+       with the whole data section parsed up front.  Return an exit
+       status."""
+    tmp_dir = tempfile.mkdtemp(prefix='mmdb-bench-')
+    failures = 0
+    runs = [(jobs, True) for jobs in options.jobs] + [(1, False)]
+    try:
+        mmdb_filename = os.path.join(tmp_dir, 'test.mmdb')
+        for record_size in options.record_size:
+            for case in CHECK_CASES:
+                for jobs, lazy in runs:
+                    desc = "record_size=%d jobs=%d%s %s" % (
+                        record_size, jobs, "" if lazy else " eager",
+                        " ".join("%s=%s" % kv for kv in sorted(case.items())))
+                    try:
+                        expected = build_database(mmdb_filename,
+                                                  record_size=record_size,
+                                                  seed=options.seed, **case)
+                        geoip, geoip6 = convert(converter, mmdb_filename,
+                                                tmp_dir, jobs, lazy)
+                        problems = (
+                            compare_ranges('geoip',
+                                           read_geoip_file(geoip, int),
+                                           expected[0]) +
+                            compare_ranges('geoip6',
+                                           read_geoip_file(geoip6,
+                                                           parse_ipv6),
+                                           expected[1]))
+                    except Exception as e:
+                        problems = ["%s: %s" % (type(e).__name__, e)]
+                    print("%s: %s" % ("FAIL" if problems else "ok", desc))
+                    for problem in problems:
+                        print("    " + problem)
+                    if problems:
+                        failures += 1
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 1 if failures else 0
+
+def peak_rss_kb():
+    """Return the peak RSS of this process so far, in KB."""
+    # Linux carries ru_maxrss over from the parent process, even across
+    # exec, so use VmHWM from /proc where we can.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+def time_conversion(converter, mmdb_filename, out_dir):
+    """Convert mmdb_filename one phase at a time, and return a list of
+       (phase, seconds, peak RSS in KB) triples."""
+    results = []
+    def phase(name, start):
+        "Helper: record a phase that started at 'start'."
+        results.append((name, time.time() - start, peak_rss_kb()))
+        return time.time()
+
+    t = time.time()
+    metadata, tree, _ = converter.parse_mm_file(
+        converter.open_mm_file(mmdb_filename))
+    t = phase('parse', t)
+
+    # Decode and format every record that the tree points at.
+    leaves = set(tree.left)
+    leaves.update(tree.right)
+    for record in leaves:
+        if record > tree.node_count:
+            converter.format_datum(tree.datum(record))
+    del leaves
+    t = phase('resolve', t)
+
+    entries = (converter.RangeList(), converter.RangeList())
+    converter.dump_tree(entries, tree, converter.dump_item_ipv4_and_ipv6,
+                        prune=converter.IPV4_ALIAS_SUBNETS)
+    t = phase('traverse', t)
+
+    writers = (converter.GeoIPWriter(os.path.join(out_dir, 'geoip'),
+                                     metadata, converter.fmt_item_ipv4),
+               converter.GeoIPWriter(os.path.join(out_dir, 'geoip6'),
+                                     metadata, converter.fmt_item_ipv6))
+    for writer, family_entries in zip(writers, entries):
+        for entry in family_entries:
+            writer.append(entry)
+        writer.close()
+    phase('write', t)
+
+    return results
+
+def cmd_bench(converter, options):
+    """Build a synthetic database, and time its conversion.  Return an
+       exit status."""
+    tmp_dir = tempfile.mkdtemp(prefix='mmdb-bench-')
+    try:
+        mmdb_filename = os.path.join(tmp_dir, 'bench.mmdb')
+        build_database(mmdb_filename, options.ipv4_networks,
+                       options.ipv6_networks, options.record_size[0],
+                       options.shape, options.records, seed=options.seed)
+        print("database: %d bytes, record_size=%d shape=%s" %
+              (os.path.getsize(mmdb_filename), options.record_size[0],
+               options.shape))
+
+        # Time each run in a fresh process, so that building the database
+        # doesn't count towards its peak RSS.
+        for run in range(options.repeat):
+            for jobs in options.jobs:
+                out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__),
+                     '--jobs', str(jobs), 'time-run', mmdb_filename,
+                     tmp_dir])
+                result = json.loads(out.decode('utf8'))
+                print("run %d, jobs=%d:" % (run + 1, jobs))
+                for name, seconds, rss in result:
+                    print("    %-10s %8.3fs  %8d KB peak RSS" %
+                          (name, seconds, rss))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+def cmd_time_run(converter, options):
+    """Time the conversion of one database, and print the results as
+       JSON.  Used by cmd_bench."""
+    if options.jobs[0] > 1:
+        t = time.time()
+        convert(converter, options.mmdb_file, options.out_dir,
+                options.jobs[0])
+        results = [('convert', time.time() - t, peak_rss_kb())]
+    else:
+        results = time_conversion(converter, options.mmdb_file,
+                                  options.out_dir)
+        t = time.time()
+        convert(converter, options.mmdb_file, options.out_dir)
+        results.append(('convert', time.time() - t, peak_rss_kb()))
+    print(json.dumps(results))
+    return 0
+
+def cmd_write(converter, options):
+    "Write a synthetic database.  Return an exit status."
+    build_database(options.mmdb_file, options.ipv4_networks,
+                   options.ipv6_networks, options.record_size[0],
+                   options.shape, options.records, seed=options.seed)
+    return 0
+
+def int_list(arg):
+    "Parse a comma-separated list of integers, for argparse."
+    try:
+        return [int(x) for x in arg.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a list of integers" % arg)
+
+def main(args):
+    "Parse the command line in args, and run the command it names."
+    parser = argparse.ArgumentParser(
+        description="Test and benchmark mmdb-convert.py with synthetic "
+                    "MaxMind-DB files.")
+    parser.add_argument('--record-size', type=int_list,
+                        default=[24, 28, 32],
+                        help="Comma-separated record sizes in bits "
+                             "(default: 24,28,32; write and bench use the "
+                             "first one)")
+    parser.add_argument('--jobs', type=int_list, default=[1],
+                        help="Comma-separated numbers of processes to "
+                             "convert with (default: 1)")
+    parser.add_argument('--ipv4-networks', type=int, default=200000,
+                        help="Number of IPv4 networks (default: 200000)")
+    parser.add_argument('--ipv6-networks', type=int, default=50000,
+                        help="Number of IPv6 networks (default: 50000)")
+    parser.add_argument('--records', type=int, default=1000,
+                        help="Number of distinct records (default: 1000)")
+    parser.add_argument('--shape', choices=SHAPES, default='country',
+                        help="What the records hold (default: country)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="How many times to run the benchmark")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for the random number generator")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    write_parser = subparsers.add_parser('write',
+                                         help="Write a synthetic database")
+    write_parser.add_argument('mmdb_file')
+    subparsers.add_parser('check', help="Run the round-trip checks")
+    subparsers.add_parser('bench', help="Run the benchmark")
+    time_parser = subparsers.add_parser('time-run')
+    time_parser.add_argument('mmdb_file')
+    time_parser.add_argument('out_dir')
+    options = parser.parse_args(args)
+    for record_size in options.record_size:
+        if record_size not in (24, 28, 32):
+            parser.error("Unsupported record size in bits: %d" % record_size)
+
+    command = {'write': cmd_write,
+               'check': cmd_check,
+               'bench': cmd_bench,
+               'time-run': cmd_time_run}[options.command]
+    return command(load_converter(), options)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
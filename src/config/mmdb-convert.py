@@ -16,7 +16,8 @@
 
 """This kludge is meant to
    parse mmdb files in sufficient detail to dump out the old format
-   that Tor expects.  It's also meant to be pure-python.
+   that Tor expects.  It's also meant to be pure-python, and needs
+   Python 3.
 
    When given a simplicity/speed tradeoff, it opts for simplicity.
 
@@ -28,41 +29,140 @@
    pieces.
 """
 
+import argparse
 import struct
-import bisect
 import socket
 import binascii
+import contextlib
+import json
+import mmap
+import multiprocessing
+import os
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
 import sys
 import time
+import zlib
 
-METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
-
-# Here's some python2/python3 junk.  Better solutions wanted.
+# We don't need numpy, but we'll use it to decode the search tree if we have
+# it.
 try:
-    ord(b"1"[0])
-except TypeError:
-    def byte_to_int(b):
-        "convert a single element of a bytestring to an integer."
-        return b
-else:
-    byte_to_int = ord
+    import numpy
+except ImportError:
+    numpy = None
 
-# Here's some more python2/python3 junk.  Better solutions wanted.
+# We only need resource for the peak memory use in --stats, and it's
+# Unix-only.
 try:
-    str(b"a", "utf8")
-except TypeError:
-    bytesToStr = str
-else:
-    def bytesToStr(b):
-        "convert a bytestring in utf8 to a string."
-        return str(b, 'utf8')
+    import resource
+except ImportError:
+    resource = None
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+
+# The spec limits the metadata, marker included, to the last 128KiB of the
+# file, so that's as far back as we look for it.
+METADATA_MAX_SIZE = 128 * 1024
+
+def peak_rss_kb(who='self'):
+    """Return the peak resident set size of this process (or, if 'who' is
+       'children', of the largest of its finished child processes) in KiB,
+       or None if we can't tell."""
+    if resource is None:
+        return None
+    if who == 'children':
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    if sys.platform == 'darwin':
+        # macOS reports bytes rather than KiB.
+        return usage.ru_maxrss // 1024
+    return usage.ru_maxrss
+
+class Stats(object):
+    """Timings and counters for one conversion, for --stats.
+
+       Each phase records its wall-clock time, the CPU time this process
+       spent in it, and our peak RSS at the end of it.  Counters are
+       plain totals that the code we're measuring adds to.
+
+       Nothing is recorded unless 'enabled' is set, so that library users
+       (and conversions without --stats) don't pay for it."""
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.counters = {}
+
+    def add(self, name, n=1):
+        "Add n to the counter called name."
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_counters(self, counters):
+        "Add each of the counters in the dict 'counters' to ours."
+        for name, n in counters.items():
+            self.add(name, n)
+
+    def take_counters(self):
+        "Return our counters, and start new ones from zero."
+        counters = self.counters
+        self.counters = {}
+        return counters
+
+    def record(self, name, wall_time, cpu_time):
+        "Record a phase called name that took the times we're given."
+        if not self.enabled:
+            return
+        self.phases.append(OrderedDict([
+            ('phase', name),
+            ('wall_time', round(wall_time, 6)),
+            ('cpu_time', round(cpu_time, 6)),
+            ('peak_rss_kb', peak_rss_kb())]))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        "Record the code in a with-block as a phase called name."
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.time(), time.process_time()
+        yield
+        self.record(name, time.time() - wall, time.process_time() - cpu)
+
+    def ratio(self, name, hits, lookups):
+        """Set the counter called name to the ratio of the counters hits
+           and lookups, if there were any lookups."""
+        if self.counters.get(lookups):
+            self.counters[name] = round(
+                self.counters.get(hits, 0) / float(self.counters[lookups]), 6)
+
+    def write_json(self, fobj):
+        "Write everything we've recorded to fobj, as a JSON object."
+        self.ratio('datum_cache_hit_rate', 'datum_cache_hits',
+                   'datum_cache_lookups')
+        self.ratio('format_cache_hit_rate', 'format_cache_hits',
+                   'leaves_visited')
+        result = OrderedDict([
+            ('phases', self.phases),
+            ('counters', OrderedDict(sorted(self.counters.items()))),
+            ('total_wall_time',
+             round(sum(p['wall_time'] for p in self.phases), 6)),
+            ('peak_rss_kb', peak_rss_kb()),
+            ('workers_peak_rss_kb', peak_rss_kb('children'))])
+        json.dump(result, fobj, indent=2)
+        fobj.write("\n")
+
+# What this conversion has done so far, for --stats.  Worker processes have
+# their own, and send their counters back with their results.
+stats = Stats()
 
 def to_int(s):
     "Parse a big-endian integer from bytestring s."
     result = 0
     for c in s:
         result *= 256
-        result += byte_to_int(c)
+        result += c
     return result
 
 def to_int24(s):
@@ -77,100 +177,166 @@ def to_int32(s):
 
 def to_int28(s):
     "Parse a pair of big-endian 28-bit integers from bytestring s."
-    a, b = unpack("!LL", s + b'\x00')
+    a, b = struct.unpack("!LL", s + b'\x00')
     return (((a & 0xf0) << 20) + (a >> 8)), ((a & 0x0f) << 24) + (b >> 8)
 
-class Tree(object):
-    "Holds a node in the tree"
+# The typecode for an array of unsigned 32-bit integers.
+if array('I').itemsize == 4:
+    UINT32_TYPECODE = 'I'
+else:
+    UINT32_TYPECODE = 'L'
+
+def uint32_array(s):
+    "Parse an array of big-endian 32-bit integers from bytestring s."
+    result = array(UINT32_TYPECODE)
+    result.frombytes(s)
+    if sys.byteorder == 'little':
+        result.byteswap()
+    return result
+
+class SearchTree(object):
+    """Holds the search tree, as two parallel arrays of 32-bit records:
+       the left and right records of every node.  A record less than
+       node_count is the index of another node; a record equal to
+       node_count means that there's no data; and any other record points
+       into the data section.
+
+       A tree with millions of nodes is far too big to hold as one Python
+       object per node.
+
+       The find_datum field is a function that returns the Datum at a given
+       position in the data section; parse_mm_file() fills it in.
+    """
     def __init__(self, left, right):
         self.left = left
         self.right = right
-
-def resolve_tree(tree, data):
-    """Fill in the left_item and right_item fields for all values in the tree
-       so that they point to another Tree, or to a Datum, or to None."""
-    d = Datum(None, None, None, None)
-    def resolve_item(item):
-        "Helper: resolve a single index."
-        if item < len(tree):
-            return tree[item]
-        elif item == len(tree):
-            return None
-        else:
-            d.pos = (item - len(tree) - 16)
-            p = bisect.bisect_left(data, d)
-            assert data[p].pos == d.pos
-            return data[p]
-
-    for t in tree:
-        t.left_item = resolve_item(t.left)
-        t.right_item = resolve_item(t.right)
+        self.node_count = len(left)
+        self.find_datum = None
+
+    def __len__(self):
+        return self.node_count
+
+    def datum(self, record):
+        """Return the Datum that the data-section record 'record' points
+           to."""
+        return self.find_datum(record - self.node_count - 16)
+
+# Translation tables that pick out the high and low nibbles of a byte.
+HIGH_NIBBLE = bytes(bytearray(i >> 4 for i in range(256)))
+LOW_NIBBLE = bytes(bytearray(i & 0x0f for i in range(256)))
+
+def decode_records(s, record_size, n_nodes):
+    """Decode the n_nodes nodes of the search tree in s, with the given
+       record size in bits.  Return a pair of arrays of the left and right
+       records.
+
+       We don't decode the nodes one at a time: instead, we widen every
+       record to 32 bits with strided slice assignment (which runs in C),
+       and parse them all at once."""
+    if record_size == 32:
+        records = uint32_array(s)
+    else:
+        widened = bytearray(n_nodes * 8)
+        if record_size == 24:
+            for i in range(3):
+                widened[i+1::8] = s[i::6]
+                widened[i+5::8] = s[i+3::6]
+        elif record_size == 28:
+            # The middle byte of each node holds the high nibbles of both
+            # records.
+            middle = bytes(s[3::7])
+            widened[0::8] = middle.translate(HIGH_NIBBLE)
+            widened[4::8] = middle.translate(LOW_NIBBLE)
+            del middle
+            for i in range(3):
+                widened[i+1::8] = s[i::7]
+                widened[i+5::8] = s[i+4::7]
+        records = uint32_array(widened)
+        del widened
+    return records[0::2], records[1::2]
+
+def decode_records_numpy(s, record_size, n_nodes):
+    """As decode_records, but use numpy to do the work."""
+    record_bytes = (record_size*2) // 8
+    if record_size == 32:
+        pairs = numpy.frombuffer(s, '>u4', n_nodes * 2).reshape(n_nodes, 2)
+        left = pairs[:, 0]
+        right = pairs[:, 1]
+    else:
+        raw = numpy.frombuffer(s, numpy.uint8, n_nodes * record_bytes)
+        raw = raw.reshape(n_nodes, record_bytes)
+        def column(i):
+            "Helper: return byte i of every node, widened to 32 bits."
+            return raw[:, i].astype(numpy.uint32)
+        # The right record is in the last three bytes of the node.
+        r = record_bytes - 3
+        left = (column(0) << 16) | (column(1) << 8) | column(2)
+        right = (column(r) << 16) | (column(r+1) << 8) | column(r+2)
+        if record_size == 28:
+            middle = column(3)
+            left |= (middle & 0xf0) << 20
+            right |= (middle & 0x0f) << 24
+    return (array(UINT32_TYPECODE, left.astype('=u4').tobytes()),
+            array(UINT32_TYPECODE, right.astype('=u4').tobytes()))
 
 def parse_search_tree(s, record_size):
     """Given a bytestring and a record size in bits, parse the tree.
-       Return a list of nodes."""
-    record_bytes = (record_size*2) // 8
-    nodes = []
-    p = 0
-    try:
-        to_leftright = { 24: to_int24,
-                         28: to_int28,
-                         32: to_int32 }[ record_size ]
-    except KeyError:
+       Return a SearchTree."""
+    if record_size not in (24, 28, 32):
         raise NotImplementedError("Unsupported record size in bits: %d" %
                                   record_size)
-    while p < len(s):
-        left, right = to_leftright(s[p:p+record_bytes])
-        p += record_bytes
-
-        nodes.append( Tree(left, right ) )
+    n_nodes = len(s) // ((record_size*2) // 8)
+    if numpy is not None:
+        left, right = decode_records_numpy(s, record_size, n_nodes)
+    else:
+        left, right = decode_records(s, record_size, n_nodes)
 
-    return nodes
+    return SearchTree(left, right)
 
 class Datum(object):
     """Holds a single entry from the Data section"""
+    # A full parse makes millions of these, so we give them slots rather
+    # than a __dict__ apiece.
+    __slots__ = ('pos', 'kind', 'ln', 'data', 'children', '_map', 'ptr')
+
     def __init__(self, pos, kind, ln, data):
         self.pos = pos    # Position of this record within data section
         self.kind = kind  # Type of this record. one of TP_*
         self.ln = ln      # Length field, which might be overloaded.
         self.data = data  # Raw bytes data.
         self.children = None # Used for arrays and maps.
+        self._map = None  # For maps, a dict from key to value Datum.
+        self.ptr = None   # For pointers, the pointed-to Datum.
 
     def __repr__(self):
         return "Datum(%r,%r,%r,%r)" % (self.pos, self.kind, self.ln, self.data)
 
-    # Comparison functions used for bsearch
-    def __lt__(self, other):
-        return self.pos < other.pos
+    @property
+    def map(self):
+        """If this is a map, a dict from its keys to its (dereferenced)
+           values.  We only build the dict the first time somebody asks for
+           it, since most maps in a full parse are never looked at."""
+        if self._map is None and self.kind == TP_MAP:
+            self.build_maps()
+        return self._map
 
-    def __gt__(self, other):
-        return self.pos > other.pos
-
-    def __eq__(self, other):
-        return self.pos == other.pos
+    @map.setter
+    def map(self, value):
+        self._map = value
 
     def build_maps(self):
-        """If this is a map or array, fill in its 'map' field if it's a map,
-           and the 'map' field of all its children."""
-
-        if not hasattr(self, 'nChildren'):
+        """If this is a map, fill in its 'map' field from its children."""
+        if self.kind != TP_MAP:
             return
 
-        if self.kind == TP_ARRAY:
-            del self.nChildren
-            for c in self.children:
-                c.build_maps()
-
-        elif self.kind == TP_MAP:
-            del self.nChildren
-            self.map = {}
-            for i in range(0, len(self.children), 2):
-                k = self.children[i].deref()
-                v = self.children[i+1].deref()
-                v.build_maps()
-                if k.kind != TP_UTF8:
-                    raise ValueError("Bad dictionary key type %d"% k.kind)
-                self.map[bytesToStr(k.data)] = v
+        m = {}
+        for i in range(0, len(self.children), 2):
+            k = self.children[i].deref()
+            v = self.children[i+1].deref()
+            if k.kind != TP_UTF8:
+                raise ValueError("Bad dictionary key type %d"% k.kind)
+            m[str(k.data, 'utf8')] = v
+        self._map = m
 
     def int_val(self):
         """If this is an integer type, return its value"""
@@ -194,15 +360,12 @@ class Datum(object):
             assert n < 100
         return s
 
-def resolve_pointers(data):
-    """Fill in the ptr field of every pointer in data."""
-    search = Datum(None, None, None, None)
+def resolve_pointers(data, index):
+    """Fill in the ptr field of every pointer in data.  'index' maps each
+       position in the data section to the Datum found there."""
     for d in data:
         if d.kind == TP_PTR:
-            search.pos = d.ln
-            p = bisect.bisect_left(data, search)
-            assert data[p].pos == d.ln
-            d.ptr = data[p]
+            d.ptr = index[d.ln]
 
 TP_PTR = 1
 TP_UTF8 = 2
@@ -220,15 +383,15 @@ TP_END = 13
 TP_BOOL = 14
 TP_FLOAT = 15
 
-def get_type_and_len(s):
+def get_type_and_len(s, pos):
     """Data parsing helper: decode the type value and much-overloaded 'length'
-       field for the value starting at s.  Return a 3-tuple of type, length,
-       and number of bytes used to encode type-plus-length."""
-    c = byte_to_int(s[0])
+       field for the value starting at s[pos].  Return a 3-tuple of type,
+       length, and number of bytes used to encode type-plus-length."""
+    c = s[pos]
     tp = c >> 5
     skip = 1
     if tp == 0:
-        tp = byte_to_int(s[1])+7
+        tp = s[pos+1]+7
         skip = 2
     ln = c & 31
 
@@ -240,12 +403,12 @@ def get_type_and_len(s):
             ln <<= len_len * 8
         else:
             ln = 0
-        ln += to_int(s[skip:skip+len_len])
+        ln += to_int(s[pos+skip:pos+skip+len_len])
         ln += (0, 0, 2048, 526336, 0)[len_len]
         skip += len_len
     elif ln >= 29:
         len_len = ln - 28
-        ln = to_int(s[skip:skip+len_len])
+        ln = to_int(s[pos+skip:pos+skip+len_len])
         ln += (0, 29, 285, 65821)[len_len]
         skip += len_len
 
@@ -260,79 +423,271 @@ IGNORE_LEN_TYPES = set([
     TP_DCACHE, # Length is number of members that follow
 ])
 
-def parse_data_section(s):
-    """Given a data section encoded in a bytestring, return a list of
-       Datum items."""
+def parse_data_section(s, start=0, end=None, index=None):
+    """Given a buffer holding a data section in s[start:end], return a list
+       of Datum items.  We walk the buffer by offset rather than slicing
+       off each record as we go: with a memoryview or an mmap, the only
+       bytes we copy are the ones the Datum items refer to.
+
+       If 'index' is provided, it should be a dict: we add every Datum to
+       it, keyed by position, so that pointers and tree records can be
+       resolved without searching."""
+
+    if end is None:
+        end = len(s)
 
-    # Stack of possibly nested containers.  We use the 'nChildren' member of
-    # the last one to tell how many more items nest directly inside.
+    # Stack of possibly nested containers, as [Datum, number of items that
+    # have yet to nest directly inside it] lists.
     stack = []
 
     # List of all items, including nested ones.
     data = []
 
-    # Byte index within the data section.
-    pos = 0
+    # Byte index within s.
+    pos = start
 
-    while s:
-        tp, ln, skip = get_type_and_len(s)
+    while pos < end:
+        tp, ln, skip = get_type_and_len(s, pos)
         if tp in IGNORE_LEN_TYPES:
             real_len = 0
         else:
             real_len = ln
 
-        d = Datum(pos, tp, ln, s[skip:skip+real_len])
+        # Copy the bytes out, rather than keeping a slice of s: a
+        # memoryview slice is several times the size of a short bytes.
+        if real_len:
+            raw = bytes(s[pos+skip:pos+skip+real_len])
+        else:
+            raw = b''
+        d = Datum(pos - start, tp, ln, raw)
         data.append(d)
+        if index is not None:
+            index[d.pos] = d
         pos += skip+real_len
-        s = s[skip+real_len:]
 
         if stack:
-            stack[-1].children.append(d)
-            stack[-1].nChildren -= 1
-            if stack[-1].nChildren == 0:
+            top = stack[-1]
+            top[0].children.append(d)
+            top[1] -= 1
+            if top[1] == 0:
                 del stack[-1]
 
-        if d.kind == TP_ARRAY:
-            d.nChildren = d.ln
+        if d.kind == TP_ARRAY and d.ln:
+            d.children = []
+            stack.append([d, d.ln])
+        elif d.kind == TP_MAP and d.ln:
             d.children = []
-            stack.append(d)
-        elif d.kind == TP_MAP:
-            d.nChildren = d.ln * 2
+            stack.append([d, d.ln * 2])
+        elif d.kind in (TP_ARRAY, TP_MAP):
             d.children = []
-            stack.append(d)
 
     return data
 
-def parse_mm_file(s):
-    """Parse a MaxMind-DB file."""
-    try:
-        metadata_ptr = s.rindex(METADATA_MARKER)
-    except ValueError:
+class LazyMap(Mapping):
+    """A map from a data section whose values are stored as positions, and
+       only decoded when somebody looks them up.  Every way of getting at
+       the values (get, items, values, comparison) goes through
+       __getitem__, so callers always see Datum items."""
+    def __init__(self, section):
+        self.section = section
+        self.positions = {}  # Map from key to position of its value.
+
+    def __getitem__(self, key):
+        return self.section.decode(self.positions[key])
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+class DataSection(object):
+    """Decodes items from the data section held in s[start:end] on demand.
+
+       Parsing the whole data section up front is wasteful: we only ever
+       look at a couple of fields of the records that the tree points to,
+       and the rest (names in a dozen languages, continents, and so on)
+       can be skipped over without building a Datum for them.  Every
+       position we do decode is remembered, so that records shared by many
+       tree leaves are only decoded once.
+    """
+    def __init__(self, s, start, end, cache=None):
+        self.s = s
+        self.start = start
+        self.end = end
+        if cache is None:
+            cache = {}
+        self.cache = cache  # Map from position to decoded Datum.
+
+    def decode(self, pos):
+        """Return the Datum at 'pos' within the data section.  Pointers are
+           chased, and maps get a LazyMap in their 'map' field."""
+        counting = stats.enabled
+        if counting:
+            stats.add('datum_cache_lookups')
+        try:
+            d = self.cache[pos]
+        except KeyError:
+            pass
+        else:
+            if counting:
+                stats.add('datum_cache_hits')
+            return d
+        d = self.decode_uncached(pos)
+        self.cache[pos] = d
+        return d
+
+    def decode_uncached(self, pos):
+        """Helper: decode the Datum at 'pos' without consulting the cache."""
+        s = self.s
+        start = self.start
+        tp, ln, skip = get_type_and_len(s, start + pos)
+        if tp == TP_PTR:
+            return self.decode(ln)
+
+        if tp in IGNORE_LEN_TYPES:
+            real_len = 0
+        else:
+            real_len = ln
+        p = start + pos + skip
+        # Copy the bytes out, as parse_data_section does, so that the
+        # Datum doesn't keep the buffer (and its mmap) alive.
+        d = Datum(pos, tp, ln, bytes(s[p:p+real_len]))
+
+        if tp == TP_MAP:
+            d.map = LazyMap(self)
+            p = pos + skip
+            for _ in range(ln):
+                k = self.decode(p)
+                if k.kind != TP_UTF8:
+                    raise ValueError("Bad dictionary key type %d"% k.kind)
+                p = self.skip(p)
+                d.map.positions[str(k.data, 'utf8')] = p
+                p = self.skip(p)
+        elif tp == TP_ARRAY:
+            d.children = []
+            p = pos + skip
+            for _ in range(ln):
+                d.children.append(self.decode(p))
+                p = self.skip(p)
+
+        return d
+
+    def skip(self, pos):
+        """Return the position just after the value at 'pos', without
+           decoding it or anything nested inside it."""
+        s = self.s
+        start = self.start
+        todo = 1
+        while todo:
+            tp, ln, skip = get_type_and_len(s, start + pos)
+            pos += skip
+            todo -= 1
+            if tp == TP_MAP:
+                todo += ln * 2
+            elif tp == TP_ARRAY:
+                todo += ln
+            elif tp not in IGNORE_LEN_TYPES:
+                pos += ln
+        return pos
+
+def parse_metadata(s):
+    """Find and parse the metadata of the MaxMind-DB file held in s.
+       Return a 3-tuple of the metadata as a list of Datum items, a dict of
+       its top-level map, and the position of the metadata marker.
+
+       We only search the end of s for the metadata, so this is cheap even
+       for a large file; callers should check_metadata before they look at
+       the rest of the file."""
+    metadata_ptr = s.rfind(METADATA_MARKER,
+                           max(0, len(s) - METADATA_MAX_SIZE))
+    if metadata_ptr < 0:
         raise ValueError("No metadata!")
 
-    metadata = parse_data_section(s[metadata_ptr+len(METADATA_MARKER):])
+    metadata = parse_data_section(memoryview(s),
+                                  metadata_ptr+len(METADATA_MARKER))
 
-    if metadata[0].kind != TP_MAP:
+    if not metadata or metadata[0].kind != TP_MAP:
         raise ValueError("Bad map")
 
-    metadata[0].build_maps()
-    mm = metadata[0].map
-
-    tree_size = (((mm['record_size'].int_val() * 2) // 8 ) *
-                 mm['node_count'].int_val())
-
-    if s[tree_size:tree_size+16] != b'\x00'*16:
+    return metadata, metadata[0].map, metadata_ptr
+
+# The types that Datum.int_val can handle.
+INT_TYPES = frozenset([TP_UINT16, TP_UINT32, TP_UINT64, TP_UINT128,
+                       TP_SINT32])
+
+def metadata_int(mm, key):
+    """Return the value of the integer called key in mm, the top-level map
+       of the metadata."""
+    if key not in mm:
+        raise ValueError("Metadata has no %s" % key)
+    if mm[key].kind not in INT_TYPES:
+        raise ValueError("Metadata %s is not an integer" % key)
+    return mm[key].int_val()
+
+def check_metadata(mm, metadata_ptr):
+    """Make sure that mm, the top-level map of the metadata that we found
+       at metadata_ptr, describes a file that we can parse.  Return the size
+       of its search tree in bytes."""
+    major_version = metadata_int(mm, 'binary_format_major_version')
+    if major_version != 2:
+        raise NotImplementedError("Unsupported format version: %d" %
+                                  major_version)
+    record_size = metadata_int(mm, 'record_size')
+    if record_size not in (24, 28, 32):
+        raise NotImplementedError("Unsupported record size in bits: %d" %
+                                  record_size)
+    ip_version = metadata_int(mm, 'ip_version')
+    if ip_version not in (4, 6):
+        raise ValueError("Bad IP version: %d" % ip_version)
+    node_count = metadata_int(mm, 'node_count')
+    if node_count >= 1 << record_size:
+        raise ValueError("Too many nodes for %d-bit records: %d" %
+                         (record_size, node_count))
+
+    tree_size = ((record_size * 2) // 8) * node_count
+    if tree_size + 16 > metadata_ptr:
+        raise ValueError("Search tree runs past the metadata!")
+    return tree_size
+
+def parse_mm_file(s, lazy=True):
+    """Parse a MaxMind-DB file held in s, which may be a bytestring or an
+       mmap.
+
+       If 'lazy' is true, return the data section as a DataSection, and only
+       decode the records that the tree refers to.  Otherwise, decode every
+       record in the data section up front, and return them as a list of
+       Datum."""
+    with stats.phase('metadata'):
+        metadata, mm, metadata_ptr = parse_metadata(s)
+        tree_size = check_metadata(mm, metadata_ptr)
+
+    # All the parsing below works on offsets into this view, so that we
+    # never copy the (large) sections of the file.
+    view = memoryview(s)
+
+    if view[tree_size:tree_size+16] != b'\x00'*16:
         raise ValueError("Missing section separator!")
 
-    tree = parse_search_tree(s[:tree_size], mm['record_size'].int_val())
-
-    data = parse_data_section(s[tree_size+16:metadata_ptr])
+    with stats.phase('tree'):
+        tree = parse_search_tree(view[:tree_size],
+                                 mm['record_size'].int_val())
 
-    resolve_pointers(data)
-    resolve_tree(tree, data)
+    if lazy:
+        # The records are decoded as the tree walk reaches them, so their
+        # time shows up in the traversal.
+        with stats.phase('data'):
+            data = DataSection(view, tree_size+16, metadata_ptr)
+            tree.find_datum = data.decode
+    else:
+        index = {}
+        with stats.phase('data'):
+            data = parse_data_section(view, tree_size+16, metadata_ptr,
+                                      index)
 
-    for d in data:
-        d.build_maps()
+        with stats.phase('pointers'):
+            resolve_pointers(data, index)
+            tree.find_datum = index.__getitem__
 
     return metadata, tree, data
 
@@ -350,117 +705,922 @@ def format_datum(datum):
        fill all A1 entries with what ARIN et. al think.
     """
     try:
-        return bytesToStr(datum.map['country'].map['iso_code'].data)
+        return str(datum.map['country'].map['iso_code'].data, 'utf8')
     except KeyError:
         pass
     try:
-        return bytesToStr(datum.map['registered_country'].map['iso_code'].data)
+        return str(datum.map['registered_country'].map['iso_code'].data,
+                   'utf8')
     except KeyError:
         pass
     return None
 
-IPV4_PREFIX = "0"*96
+# Subnets are given as (prefix, prefix length in bits) pairs, where prefix
+# holds the high bits of the subnet's addresses as an integer.
+IPV4_SUBNET = (0, 96)
+
+def in_subnet(prefix, depth, subnet):
+    """Return true iff every address that starts with the 'depth'-bit
+       integer 'prefix' is in 'subnet'."""
+    subnet_prefix, subnet_len = subnet
+    return depth >= subnet_len and \
+        prefix >> (depth - subnet_len) == subnet_prefix
 
-def dump_item_ipv4(entries, prefix, val):
+def dump_item_ipv4(entries, prefix, depth, val):
     """Dump the information for an IPv4 address to entries, where 'prefix'
-       is a string holding a binary prefix for the address, and 'val' is the
-       value to dump.  If the prefix is not an IPv4 address (it does not start
-       with 96 bits of 0), then print nothing.
+       is an integer holding the first 'depth' bits of the address, and
+       'val' is the value to dump.  If the prefix is not an IPv4 address
+       (it does not start with 96 bits of 0), then print nothing.
     """
-    if not prefix.startswith(IPV4_PREFIX):
+    if not in_subnet(prefix, depth, IPV4_SUBNET):
         return
-    prefix = prefix[96:]
-    v = int(prefix, 2)
-    shift = 32 - len(prefix)
-    lo = v << shift
-    hi = ((v+1) << shift) - 1
+    shift = 128 - depth
+    lo = prefix << shift
+    hi = ((prefix+1) << shift) - 1
     entries.append((lo, hi, val))
 
 def fmt_item_ipv4(entry):
     """Format an IPv4 range with lo and hi addresses in decimal form."""
     return "%d,%d,%s\n"%(entry[0], entry[1], entry[2])
 
+def ipv6_template(zero_groups, low_groups):
+    """Return a format string for IPv6 addresses whose top four groups are
+       zero where the bits of the 4-bit mask zero_groups are set, and
+       nonzero elsewhere, and whose bottom four groups are the strings in
+       low_groups.  Each nonzero top group gets a %s.  We put the '::' where
+       inet_ntop does: in place of the first of the longest runs of two or
+       more zero groups."""
+    groups = ['0' if zero_groups & (8 >> i) else '%s' for i in range(4)]
+    groups += low_groups
+    best_start, best_len = None, 1
+    i = 0
+    while i < len(groups):
+        j = i
+        while j < len(groups) and groups[j] == '0':
+            j += 1
+        if j - i > best_len:
+            best_start, best_len = i, j - i
+        i = j + 1
+    if best_start is None:
+        return ':'.join(groups)
+    return (':'.join(groups[:best_start]) + '::' +
+            ':'.join(groups[best_start+best_len:]))
+
+LOW_64_BITS = (1 << 64) - 1
+
+# inet_ntop is slow, and nearly every address in a geoip6 file is the first
+# or last address of a /64 or larger block, so its low 64 bits are all
+# zeros or all ones.  We format those addresses ourselves, with these
+# templates, indexed by which of the top four groups are zero.
+IPV6_LOW_ZEROS_TEMPLATES = [ipv6_template(m, ['0'] * 4) for m in range(16)]
+IPV6_LOW_ONES_TEMPLATES = [ipv6_template(m, ['ffff'] * 4)
+                           for m in range(16)]
+
+# Map from the top or bottom 32 bits of the high half of an IPv6 address to
+# a 2-bit mask of which of its groups are zero, and a tuple of its nonzero
+# groups, formatted.  Addresses that we format one after another tend to
+# share their top bits, so these repeat a lot.
+ipv6_half_cache = {}
+IPV6_HALF_CACHE_SIZE = 1 << 16
+
+def ipv6_half(x):
+    """Return the entry for the 32-bit value x in ipv6_half_cache,
+       computing it if we have to."""
+    try:
+        return ipv6_half_cache[x]
+    except KeyError:
+        pass
+    hi, lo = x >> 16, x & 0xffff
+    result = ((not hi) << 1 | (not lo),
+              tuple("%x" % g for g in (hi, lo) if g))
+    if len(ipv6_half_cache) >= IPV6_HALF_CACHE_SIZE:
+        ipv6_half_cache.clear()
+    ipv6_half_cache[x] = result
+    return result
+
 def fmt_ipv6_addr(v):
     """Given a 128-bit integer representing an ipv6 address, return a
        string for that ipv6 address."""
-    return socket.inet_ntop(socket.AF_INET6, binascii.unhexlify("%032x"%v))
+    low = v & LOW_64_BITS
+    if low == 0:
+        templates = IPV6_LOW_ZEROS_TEMPLATES
+    elif low == LOW_64_BITS:
+        templates = IPV6_LOW_ONES_TEMPLATES
+    else:
+        return socket.inet_ntop(socket.AF_INET6,
+                                struct.pack("!QQ", v >> 64, low))
+    high = v >> 64
+    top_mask, top = ipv6_half(high >> 32)
+    bottom_mask, bottom = ipv6_half(high & 0xffffffff)
+    return templates[top_mask << 2 | bottom_mask] % (top + bottom)
+
+# Templates for whole geoip6 lines whose first address ends in 64 zero bits
+# and whose last address ends in 64 one bits, indexed by the zero-group
+# masks of their top halves, so that we can format the line with a single
+# '%'.
+IPV6_RANGE_TEMPLATES = [IPV6_LOW_ZEROS_TEMPLATES[m >> 4] + "," +
+                        IPV6_LOW_ONES_TEMPLATES[m & 15] + ",%s\n"
+                        for m in range(256)]
 
 def fmt_item_ipv6(entry):
     """Format an IPv6 range with lo and hi addresses in hex form."""
-    return "%s,%s,%s\n"%(fmt_ipv6_addr(entry[0]),
-                         fmt_ipv6_addr(entry[1]),
-                         entry[2])
-
-IPV4_MAPPED_IPV6_PREFIX = "0"*80 + "1"*16
-IPV6_6TO4_PREFIX = "0010000000000010"
-TEREDO_IPV6_PREFIX = "0010000000000001" + "0"*16
-
-def dump_item_ipv6(entries, prefix, val):
+    lo, hi, val = entry
+    if lo & LOW_64_BITS or hi & LOW_64_BITS != LOW_64_BITS:
+        return "%s,%s,%s\n"%(fmt_ipv6_addr(lo), fmt_ipv6_addr(hi), val)
+    lo >>= 64
+    hi >>= 64
+    cache = ipv6_half_cache
+    a = cache.get(lo >> 32) or ipv6_half(lo >> 32)
+    b = cache.get(lo & 0xffffffff) or ipv6_half(lo & 0xffffffff)
+    c = cache.get(hi >> 32) or ipv6_half(hi >> 32)
+    d = cache.get(hi & 0xffffffff) or ipv6_half(hi & 0xffffffff)
+    return (IPV6_RANGE_TEMPLATES[a[0] << 6 | b[0] << 4 | c[0] << 2 | d[0]] %
+            (a[1] + b[1] + c[1] + d[1] + (val,)))
+
+IPV4_MAPPED_IPV6_SUBNET = (0xffff, 96)
+IPV6_6TO4_SUBNET = (0x2002, 16)
+TEREDO_IPV6_SUBNET = (0x20010000, 32)
+
+# IPv6 subnets that MaxMind databases map onto the IPv4 subtree under
+# IPV4_SUBNET.  Neither file gets any entries from them, so there's no need
+# to walk them.
+IPV4_ALIAS_SUBNETS = (IPV4_MAPPED_IPV6_SUBNET, IPV6_6TO4_SUBNET,
+                      TEREDO_IPV6_SUBNET)
+
+# IPv6 subnets that don't hold any IPv6 addresses of their own.
+NON_IPV6_SUBNETS = (IPV4_SUBNET,) + IPV4_ALIAS_SUBNETS
+
+def dump_item_ipv6(entries, prefix, depth, val):
     """Dump the information for an IPv6 address prefix to entries, where
-       'prefix' is a string holding a binary prefix for the address,
-       and 'val' is the value to dump.  If the prefix is an IPv4 address
-       (starts with 96 bits of 0), is an IPv4-mapped IPv6 address
-       (::ffff:0:0/96), or is in the 6to4 mapping subnet (2002::/16), then
-       print nothing.
+       'prefix' is an integer holding the first 'depth' bits of the
+       address, and 'val' is the value to dump.  If the prefix is an IPv4
+       address (starts with 96 bits of 0), is an IPv4-mapped IPv6 address
+       (::ffff:0:0/96), is in the 6to4 mapping subnet (2002::/16), or is a
+       Teredo address (2001::/32), then print nothing.
     """
-    if prefix.startswith(IPV4_PREFIX) or \
-       prefix.startswith(IPV4_MAPPED_IPV6_PREFIX) or \
-       prefix.startswith(IPV6_6TO4_PREFIX) or \
-       prefix.startswith(TEREDO_IPV6_PREFIX):
-        return
-    v = int(prefix, 2)
-    shift = 128 - len(prefix)
-    lo = v << shift
-    hi = ((v+1) << shift) - 1
+    for subnet in NON_IPV6_SUBNETS:
+        if in_subnet(prefix, depth, subnet):
+            return
+    shift = 128 - depth
+    lo = prefix << shift
+    hi = ((prefix+1) << shift) - 1
     entries.append((lo, hi, val))
 
-def dump_tree(entries, node, dump_item, prefix=""):
-    """Walk the tree rooted at 'node', and call dump_item on the
-       format_datum output of every leaf of the tree."""
-
-    if isinstance(node, Tree):
-        dump_tree(entries, node.left_item, dump_item, prefix+"0")
-        dump_tree(entries, node.right_item, dump_item, prefix+"1")
-    elif isinstance(node, Datum):
-        assert node.kind == TP_MAP
-        code = format_datum(node)
-        if code:
-            dump_item(entries, prefix, code)
-    else:
-        assert node == None
+def dump_tree(entries, tree, dump_item, node=0, prefix=0, depth=0,
+              prune=()):
+    """Walk the subtree of 'tree' rooted at the node with index 'node',
+       which we reach with the 'depth'-bit address prefix 'prefix', and
+       call dump_item on the format_datum output of every leaf of the
+       tree, in address order.  Don't descend into any of the subnets in
+       'prune'."""
+
+    left = tree.left
+    right = tree.right
+    node_count = tree.node_count
+
+    # Map from leaf record to its format_datum output.  Most leaves point
+    # at one of a few hundred records, so we only format each one once.
+    codes = {}
+
+    prune = frozenset(prune)
+    prune_depth = max([subnet_len for _, subnet_len in prune] or [-1])
+
+    nodes_visited = leaves_visited = leaves_emitted = subtrees_pruned = 0
+
+    # Stack of (record, address prefix, prefix length) for the records we
+    # have yet to visit.  We push right before left, so that we pop (and
+    # dump) the lower addresses first.
+    stack = [(node, prefix, depth)]
+    while stack:
+        record, prefix, depth = stack.pop()
+        if record < node_count:
+            nodes_visited += 1
+            if depth <= prune_depth and (prefix, depth) in prune:
+                subtrees_pruned += 1
+                continue
+            prefix <<= 1
+            depth += 1
+            stack.append((right[record], prefix | 1, depth))
+            stack.append((left[record], prefix, depth))
+        elif record > node_count:
+            leaves_visited += 1
+            try:
+                code = codes[record]
+            except KeyError:
+                datum = tree.datum(record)
+                assert datum.kind == TP_MAP
+                code = codes[record] = format_datum(datum)
+            if code:
+                leaves_emitted += 1
+                dump_item(entries, prefix, depth, code)
+
+    stats.add('nodes_visited', nodes_visited)
+    stats.add('leaves_visited', leaves_visited)
+    stats.add('leaves_emitted', leaves_emitted)
+    stats.add('subtrees_pruned', subtrees_pruned)
+    stats.add('format_cache_hits', leaves_visited - len(codes))
 
 GEOIP_FILE_HEADER = """\
 # Last updated based on %s Maxmind GeoLite2 Country
 # wget https://geolite.maxmind.com/download/geoip/database/GeoLite2-Country.mmdb.gz
-# gunzip GeoLite2-Country.mmdb.gz
-# python mmdb-convert.py GeoLite2-Country.mmdb
+# python3 mmdb-convert.py GeoLite2-Country.mmdb.gz
 """
 
-def write_geoip_file(filename, metadata, the_tree, dump_item, fmt_item):
-    """Write the entries in the_tree to filename."""
-    entries = []
-    dump_tree(entries, the_tree[0], dump_item)
-    fobj = open(filename, 'w')
-
-    build_epoch = metadata[0].map['build_epoch'].int_val()
-    fobj.write(GEOIP_FILE_HEADER %
-               time.strftime('%B %-d %Y', time.gmtime(build_epoch)))
-
-    unwritten = None
-    for entry in entries:
+def dump_item_ipv4_and_ipv6(entries, prefix, depth, val):
+    """Dump the information for an address prefix to whichever of
+       entries[0] (for IPv4) and entries[1] (for IPv6) it belongs in.  See
+       dump_item_ipv4 and dump_item_ipv6."""
+    dump_item_ipv4(entries[0], prefix, depth, val)
+    dump_item_ipv6(entries[1], prefix, depth, val)
+
+# How many branches below the root of the tree we split it into subtrees,
+# when we convert it in several processes.
+DEFAULT_SPLIT_DEPTH = 8
+
+# How many bytes of output we buffer before writing them to a geoip file.
+GEOIP_WRITE_BUFFER_SIZE = 1 << 20
+
+# How many merged entries a GeoIPWriter holds before it formats them and
+# writes them out together.
+GEOIP_WRITE_BATCH_SIZE = 4096
+
+class GeoIPWriter(object):
+    """Writes (lo, hi, val) entries to a geoip file as they're appended,
+       merging adjacent ranges that have the same value, so that we never
+       need to hold all the entries in memory at once.  Entries must be
+       appended in address order.
+
+       We keep count of the ranges we merge and write, and of the time we
+       spend formatting and writing them, for --stats."""
+    def __init__(self, filename, metadata, fmt_item):
+        self.fobj = open(filename, 'w', GEOIP_WRITE_BUFFER_SIZE)
+        self.fmt_item = fmt_item
+        self.unwritten = None
+        self.pending = []  # Merged entries that we have yet to write.
+        self.ranges_coalesced = 0
+        self.ranges_written = 0
+        self.write_wall_time = 0.0
+        self.write_cpu_time = 0.0
+
+        build_epoch = metadata[0].map['build_epoch'].int_val()
+        self.fobj.write(GEOIP_FILE_HEADER %
+                        time.strftime('%B %-d %Y', time.gmtime(build_epoch)))
+
+    def append(self, entry):
+        """Add the range in entry, merging it with the previous one if we
+           can."""
+        unwritten = self.unwritten
         if not unwritten:
-            unwritten = entry
+            self.unwritten = entry
         elif unwritten[1] + 1 == entry[0] and unwritten[2] == entry[2]:
-            unwritten = (unwritten[0], entry[1], unwritten[2])
+            self.unwritten = (unwritten[0], entry[1], unwritten[2])
+            self.ranges_coalesced += 1
+        else:
+            self.pending.append(unwritten)
+            if len(self.pending) >= GEOIP_WRITE_BATCH_SIZE:
+                self.flush()
+            self.unwritten = entry
+
+    def append_run(self, first, text, last):
+        """Add a run of merged entries, as returned by format_run, merging
+           its first entry with the previous one if we can."""
+        if first is None:
+            return
+        self.append(first)
+        if last is None:
+            return
+        self.pending.append(self.unwritten)
+        self.flush(text)
+        self.unwritten = last
+
+    def flush(self, text=""):
+        """Format and write the pending entries, followed by text, which
+           holds entries that have been formatted already."""
+        wall, cpu = time.time(), time.process_time()
+        self.fobj.write("".join(map(self.fmt_item, self.pending)))
+        self.fobj.write(text)
+        self.ranges_written += len(self.pending) + text.count("\n")
+        del self.pending[:]
+        self.write_wall_time += time.time() - wall
+        self.write_cpu_time += time.process_time() - cpu
+
+    def close(self):
+        """Write out the last range, and close the file."""
+        if self.unwritten:
+            self.pending.append(self.unwritten)
+            self.unwritten = None
+        self.flush()
+        self.fobj.close()
+
+class RangeList(list):
+    """A list of (lo, hi, val) entries that merges adjacent ranges with the
+       same value as they're appended.  Entries must be appended in address
+       order."""
+    ranges_coalesced = 0
+
+    def append(self, entry):
+        if self and self[-1][1] + 1 == entry[0] and self[-1][2] == entry[2]:
+            self[-1] = (self[-1][0], entry[1], entry[2])
+            self.ranges_coalesced += 1
+        else:
+            list.append(self, entry)
+
+def split_tree(tree, split_depth, prune=()):
+    """Return a list of (record, prefix, depth) triples for the subtrees
+       that we find 'split_depth' branches below the root of 'tree', in
+       address order.  The list also holds the leaves and empty records
+       that we pass on the way down, so that between them, its subtrees
+       cover the whole tree, except for the subnets in 'prune'.
+
+       We only count nodes where both children are nodes as branches.
+       MaxMind trees have long chains of nodes that only lead one way
+       (such as the 96 nodes above the IPv4 subtree), and we need to get
+       past them to find subtrees that are worth splitting up."""
+    left = tree.left
+    right = tree.right
+    node_count = tree.node_count
+    prune = frozenset(prune)
+
+    # The nodes we walk and the subnets we prune here aren't in any
+    # subtree, so we count them for --stats as dump_tree would.
+    nodes_visited = subtrees_pruned = 0
+
+    result = []
+    stack = [(0, 0, 0, 0)]
+    while stack:
+        record, prefix, depth, branches = stack.pop()
+        if record >= node_count or branches >= split_depth:
+            result.append((record, prefix, depth))
+            continue
+        nodes_visited += 1
+        if (prefix, depth) in prune:
+            subtrees_pruned += 1
+            continue
+        if left[record] < node_count and right[record] < node_count:
+            branches += 1
+        prefix <<= 1
+        depth += 1
+        stack.append((right[record], prefix | 1, depth, branches))
+        stack.append((left[record], prefix, depth, branches))
+
+    stats.add('nodes_visited', nodes_visited)
+    stats.add('subtrees_pruned', subtrees_pruned)
+    return result
+
+# The tree that our worker processes dump subtrees from.
+worker_tree = None
+
+# While dump_tree_parallel runs, the buffer holding the database it's
+# converting.  Worker processes that fork from us inherit it, so they
+# don't need to open (or decompress) the file again.
+worker_buf = None
+
+def init_worker(mmdb_filename, stats_enabled):
+    """Set up a worker process to dump subtrees of the tree in
+       mmdb_filename, collecting counters for --stats if stats_enabled."""
+    global worker_tree
+    # Forget any counters we inherited from the parent, so that we only
+    # send back our own.
+    stats.enabled = stats_enabled
+    stats.take_counters()
+    buf = worker_buf
+    if buf is None:
+        # We weren't forked from the converting process.
+        buf = open_mm_file(mmdb_filename)
+    _, worker_tree, _ = parse_mm_file(buf)
+
+def format_run(entries, fmt_item):
+    """Given a list of merged entries, return a (first, text, last) triple,
+       where first and last are the first and last entries, and text holds
+       the entries in between, formatted with fmt_item.  If there are fewer
+       than two entries, last (and maybe first) are None."""
+    if not entries:
+        return None, "", None
+    elif len(entries) == 1:
+        return entries[0], "", None
+    else:
+        return (entries[0], "".join(map(fmt_item, entries[1:-1])),
+                entries[-1])
+
+def dump_subtree(subtree):
+    """Worker: dump the subtree whose (record, prefix, depth) is 'subtree'.
+       Return a pair of runs of merged IPv4 and IPv6 entries, as returned
+       by format_run, and the counters for --stats that the dump added up.
+
+       We do the formatting here, so that it happens in parallel, but we
+       keep the ranges at either end of each run unformatted, so that they
+       can still be merged with the ranges in neighbouring subtrees."""
+    record, prefix, depth = subtree
+    entries = (RangeList(), RangeList())
+    dump_tree(entries, worker_tree, dump_item_ipv4_and_ipv6, record,
+              prefix, depth, prune=IPV4_ALIAS_SUBNETS)
+    stats.add('ipv4_ranges_coalesced', entries[0].ranges_coalesced)
+    stats.add('ipv6_ranges_coalesced', entries[1].ranges_coalesced)
+    return (format_run(entries[0], fmt_item_ipv4),
+            format_run(entries[1], fmt_item_ipv6),
+            stats.take_counters())
+
+def dump_tree_parallel(writers, mmdb_filename, the_tree, jobs, split_depth,
+                       mmdb_buf=None):
+    """Like dump_tree with dump_item_ipv4_and_ipv6, but split the tree into
+       subtrees with split_tree, and dump them in a pool of 'jobs' worker
+       processes.  Each worker parses the tree from mmdb_buf, the buffer
+       that the_tree came from, if it can inherit it; otherwise it reads
+       the tree from mmdb_filename itself.
+       We hand the runs of entries from each subtree to the IPv4 and IPv6
+       GeoIPWriters in 'writers' in address order, so that ranges that
+       span the seams between subtrees get merged there."""
+    subtrees = split_tree(the_tree, split_depth, IPV4_ALIAS_SUBNETS)
+    chunksize = max(1, len(subtrees) // (jobs * 4))
+    stats.add('subtrees_split', len(subtrees))
+
+    global worker_buf
+    worker_buf = mmdb_buf
+    try:
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (mmdb_filename, stats.enabled))
+    finally:
+        worker_buf = None
+    try:
+        for ipv4_run, ipv6_run, counters in pool.imap(dump_subtree,
+                                                      subtrees, chunksize):
+            writers[0].append_run(*ipv4_run)
+            writers[1].append_run(*ipv6_run)
+            stats.add_counters(counters)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def write_geoip_files(ipv4_filename, ipv6_filename, metadata, the_tree,
+                      mmdb_filename=None, jobs=1,
+                      split_depth=DEFAULT_SPLIT_DEPTH, mmdb_buf=None):
+    """Write the IPv4 entries in the_tree to ipv4_filename, and the IPv6
+       entries to ipv6_filename, in a single walk over the tree.  If 'jobs'
+       is more than 1, split the walk between that many processes, which
+       read the tree from mmdb_buf (the buffer the tree came from), or
+       from mmdb_filename.
+
+       The walk and the writing are interleaved, so we record the time
+       that the writers spent formatting and writing as the 'write' phase,
+       and the rest as the 'traversal' phase."""
+    wall, cpu = time.time(), time.process_time()
+    children_cpu = sum(os.times()[2:4])
+    writers = (GeoIPWriter(ipv4_filename, metadata, fmt_item_ipv4),
+               GeoIPWriter(ipv6_filename, metadata, fmt_item_ipv6))
+    if jobs > 1:
+        dump_tree_parallel(writers, mmdb_filename, the_tree, jobs,
+                           split_depth, mmdb_buf)
+    else:
+        dump_tree(writers, the_tree, dump_item_ipv4_and_ipv6,
+                  prune=IPV4_ALIAS_SUBNETS)
+    for writer in writers:
+        writer.close()
+    wall, cpu = time.time() - wall, time.process_time() - cpu
+
+    write_wall = sum(writer.write_wall_time for writer in writers)
+    write_cpu = sum(writer.write_cpu_time for writer in writers)
+    stats.record('traversal', wall - write_wall, cpu - write_cpu)
+    stats.record('write', write_wall, write_cpu)
+    if jobs > 1:
+        stats.add('workers_cpu_time',
+                  round(sum(os.times()[2:4]) - children_cpu, 6))
+    for family, writer in zip(('ipv4', 'ipv6'), writers):
+        stats.add(family + '_ranges_coalesced', writer.ranges_coalesced)
+        stats.add(family + '_ranges_written', writer.ranges_written)
+
+def parse_ipv6_addr(s):
+    """Given a string for an ipv6 address, return the 128-bit integer that
+       represents it."""
+    return int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, s)), 16)
+
+def read_geoip_file(filename, parse_addr):
+    """Yield the (lo, hi, val) entries in the geoip or geoip6 file called
+       filename, one line at a time.  parse_addr turns the text of an
+       address into an integer: int for geoip, or parse_ipv6_addr for
+       geoip6."""
+    with open(filename) as fobj:
+        for line in fobj:
+            if line.startswith('#') or not line.strip():
+                continue
+            lo, hi, val = line.strip().split(',')
+            yield parse_addr(lo), parse_addr(hi), val
+
+# An address past the end of every address space.
+NO_ADDR = 1 << 129
+
+def diff_ranges(old, new):
+    """Given two iterators over sorted, non-overlapping (lo, hi, val)
+       entries, yield a (lo, hi, old_val, new_val) entry for every range of
+       addresses whose value is different in 'new'.  old_val or new_val is
+       None when the range isn't in 'old' or 'new'.  We only look at one
+       entry from each iterator at a time."""
+    old_entry = next(old, None)
+    new_entry = next(new, None)
+    pending = None
+    pos = 0
+    while old_entry or new_entry:
+        # Find the values at pos, and how far they stay the same.
+        old_val = new_val = None
+        end = NO_ADDR
+        for entry in (old_entry, new_entry):
+            if entry is None:
+                continue
+            elif entry[0] <= pos:
+                end = min(end, entry[1])
+            else:
+                end = min(end, entry[0] - 1)
+        if old_entry and old_entry[0] <= pos:
+            old_val = old_entry[2]
+        if new_entry and new_entry[0] <= pos:
+            new_val = new_entry[2]
+
+        if old_val != new_val:
+            if pending and pending[1] + 1 == pos and \
+               pending[2:] == (old_val, new_val):
+                pending = (pending[0], end, old_val, new_val)
+            else:
+                if pending:
+                    yield pending
+                pending = (pos, end, old_val, new_val)
+
+        pos = end + 1
+        if old_entry and old_entry[1] < pos:
+            old_entry = next(old, None)
+        if new_entry and new_entry[1] < pos:
+            new_entry = next(new, None)
+    if pending:
+        yield pending
+
+def write_geoip_diff(out, old_filename, new_filename, parse_addr, fmt_item):
+    """Write a report on the changes between the geoip (or geoip6) files
+       old_filename and new_filename to the file object 'out': a line for
+       every range that was added ("+"), removed ("-"), or reassigned to
+       another country ("~"), followed by how many addresses each country
+       gained and lost.  We read both files in a single pass, without ever
+       holding more than one line of either one."""
+    out.write("# Changes from %s to %s\n" % (old_filename, new_filename))
+    counts = {'+': 0, '-': 0, '~': 0}
+    gained = {}
+    lost = {}
+    for lo, hi, old_val, new_val in diff_ranges(
+            read_geoip_file(old_filename, parse_addr),
+            read_geoip_file(new_filename, parse_addr)):
+        n_addrs = hi - lo + 1
+        if old_val is None:
+            change = '+'
+            val = new_val
+        elif new_val is None:
+            change = '-'
+            val = old_val
+        else:
+            change = '~'
+            val = "%s->%s" % (old_val, new_val)
+        counts[change] += 1
+        if old_val is not None:
+            lost[old_val] = lost.get(old_val, 0) + n_addrs
+        if new_val is not None:
+            gained[new_val] = gained.get(new_val, 0) + n_addrs
+        out.write("%s %s" % (change, fmt_item((lo, hi, val))))
+
+    out.write("# %d ranges added, %d removed, %d reassigned\n" %
+              (counts['+'], counts['-'], counts['~']))
+    for country in sorted(set(gained) | set(lost)):
+        out.write("# %s: +%d -%d addresses\n" %
+                  (country, gained.get(country, 0), lost.get(country, 0)))
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# How many bytes of a compressed file we decompress at a time.
+GUNZIP_CHUNK_SIZE = 1 << 20
+
+def gunzip_to_mmap(fobj):
+    """Decompress the gzip file fobj into an anonymous mmap, one chunk at a
+       time, and return the mmap.  We size the mmap from the uncompressed
+       length at the end of the gzip file, so that we never hold more than
+       one copy of the decompressed data."""
+    fobj.seek(-4, os.SEEK_END)
+    size = struct.unpack("<L", fobj.read(4))[0]
+    fobj.seek(0)
+
+    buf = mmap.mmap(-1, max(size, 1))
+    length = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    done = False
+    while not done:
+        chunk = fobj.read(GUNZIP_CHUNK_SIZE)
+        if not chunk:
+            out = decompressor.flush()
+            done = True
+        else:
+            out = decompressor.decompress(chunk)
+            # A gzip file can hold several members.
+            while decompressor.unused_data:
+                rest = decompressor.unused_data
+                out += decompressor.flush()
+                if len(rest) < len(GZIP_MAGIC):
+                    rest += fobj.read(len(GZIP_MAGIC) - len(rest))
+                if not rest.startswith(GZIP_MAGIC):
+                    # Whatever follows the last member (zero padding, say)
+                    # isn't ours to decompress; gunzip ignores it too.
+                    done = True
+                    break
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out += decompressor.decompress(rest)
+        if length + len(out) > len(buf):
+            # The size at the end of the file is only the size of the last
+            # member, modulo 2**32.  Make room.
+            buf = resized_mmap(buf, length, max(length + len(out),
+                                                len(buf) * 2))
+        buf[length:length+len(out)] = out
+        length += len(out)
+
+    if length != len(buf):
+        buf = resized_mmap(buf, length, length)
+    return buf
+
+def resized_mmap(buf, length, size):
+    """Return an anonymous mmap of 'size' bytes that starts with the first
+       'length' bytes of buf, and close buf."""
+    new_buf = mmap.mmap(-1, max(size, 1))
+    new_buf[:length] = buf[:length]
+    buf.close()
+    return new_buf
+
+def open_mm_file(filename):
+    """Return a read-only mmap of the MaxMind-DB file called filename.  If
+       the file is gzip-compressed, return an anonymous mmap of its
+       decompressed contents."""
+    with open(filename, 'rb') as f:
+        if f.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+            return gunzip_to_mmap(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class LRUCache(OrderedDict):
+    """A dict that holds at most 'size' items, and forgets the least
+       recently used one to make room for more."""
+    def __init__(self, size):
+        OrderedDict.__init__(self)
+        self.size = size
+
+    def __getitem__(self, key):
+        value = OrderedDict.__getitem__(self, key)
+        # Move key to the most recently used end.
+        del self[key]
+        OrderedDict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        elif len(self) >= self.size:
+            self.popitem(last=False)
+        OrderedDict.__setitem__(self, key, value)
+
+# How many decoded data items a Reader remembers.
+DEFAULT_READER_CACHE_SIZE = 4096
+
+class Reader(object):
+    """Looks up single addresses in a MaxMind-DB file, without converting
+       or even parsing the whole thing.
+
+       We mmap the file, and only parse its metadata up front.  Each lookup
+       walks the search tree one bit at a time, reading each node from the
+       file as it goes, and only decodes the record it ends up at.  We keep
+       recently decoded items in an LRU cache.
+    """
+    def __init__(self, filename, cache_size=DEFAULT_READER_CACHE_SIZE):
+        self.buf = open_mm_file(filename)
+        self.metadata, mm, metadata_ptr = parse_metadata(self.buf)
+        tree_size = check_metadata(mm, metadata_ptr)
+        self.record_size = mm['record_size'].int_val()
+        self.node_count = mm['node_count'].int_val()
+        self.ip_version = mm['ip_version'].int_val()
+        self.to_leftright = { 24: to_int24,
+                              28: to_int28,
+                              32: to_int32 }[ self.record_size ]
+        self.node_bytes = (self.record_size * 2) // 8
+        self.data = DataSection(memoryview(self.buf), tree_size + 16,
+                                metadata_ptr, LRUCache(cache_size))
+        # The node we reach after the 96 zero bits in front of an IPv4
+        # address, once we've looked it up.
+        self.ipv4_start = None
+
+    def close(self):
+        """Unmap the file.  After this, we can't look anything else up, and
+           the maps in the Datum items we've returned can't either: they
+           decode their values from the file on demand."""
+        self.data.s.release()
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_node(self, node):
+        "Return the left and right records of the node with index 'node'."
+        p = node * self.node_bytes
+        return self.to_leftright(self.buf[p:p+self.node_bytes])
+
+    def walk(self, record, addr, n_bits):
+        """Walk down the tree from 'record', following the top n_bits bits
+           of the integer addr.  Return the record we end up at: a leaf, an
+           empty record, or (if we run out of bits) a node."""
+        for i in range(n_bits - 1, -1, -1):
+            if record >= self.node_count:
+                break
+            record = self.read_node(record)[(addr >> i) & 1]
+        return record
+
+    def get(self, address):
+        """Return the Datum for the IPv4 or IPv6 address string 'address',
+           or None if the database holds nothing for it."""
+        if ':' in address:
+            if self.ip_version != 6:
+                raise ValueError("Can't look up IPv6 addresses in an IPv4 "
+                                 "database")
+            record = self.walk(0, parse_ipv6_addr(address), 128)
         else:
-            fobj.write(fmt_item(unwritten))
-            unwritten = entry
-    if unwritten:
-        fobj.write(fmt_item(unwritten))
-    fobj.close()
+            addr = struct.unpack("!L", socket.inet_aton(address))[0]
+            if self.ip_version == 6:
+                if self.ipv4_start is None:
+                    self.ipv4_start = self.walk(0, 0, 96)
+                start = self.ipv4_start
+            else:
+                start = 0
+            record = self.walk(start, addr, 32)
+
+        if record <= self.node_count:
+            return None
+        return self.data.decode(record - self.node_count - 16)
 
-content = open(sys.argv[1], 'rb').read()
-metadata, the_tree, _ = parse_mm_file(content)
+    def country(self, address):
+        """Return the country code that we would write to the geoip files
+           for 'address', or None."""
+        datum = self.get(address)
+        if datum is None:
+            return None
+        return format_datum(datum)
+
+# The binary geoip format that write_geoip_binary writes is, with all
+# integers big-endian:
+#
+#   magic          8 bytes      GEOIP_BINARY_MAGIC
+#   version        uint16       GEOIP_BINARY_VERSION
+#   addr_bytes     uint16       4 for IPv4, 16 for IPv6
+#   n_countries    uint32
+#   n_ranges       uint32
+#   countries      n_countries * 2 bytes of ASCII country codes
+#   starts         n_ranges * addr_bytes
+#   country_index  n_ranges * uint16
+#
+# Each range runs from its start up to the next range's start, or to the
+# end of the address space.  The starts are sorted, and the first one is
+# always 0, so that a reader can mmap the file and binary-search the starts
+# for an address, without parsing anything.  Since the starts are
+# big-endian, they even sort correctly as byte strings.  Ranges that don't
+# belong to any country have a country index of GEOIP_BINARY_NO_COUNTRY.
+GEOIP_BINARY_MAGIC = b'TorGeoIP'
+GEOIP_BINARY_VERSION = 1
+GEOIP_BINARY_HEADER = "!8sHHLL"
+GEOIP_BINARY_NO_COUNTRY = 0xffff
+
+def addr_to_bytes(v, addr_bytes):
+    """Return the big-endian encoding of the address v, which is
+       addr_bytes long."""
+    return binascii.unhexlify("%0*x" % (addr_bytes * 2, v))
+
+def write_geoip_binary(filename, entries, addr_bytes):
+    """Write the (lo, hi, val) entries in 'entries', which must be sorted
+       and non-overlapping, to filename in the binary geoip format.
+       addr_bytes is the length of an address: 4 for IPv4, or 16 for
+       IPv6."""
+    countries = []
+    country_index = {}
+    starts = bytearray()
+    indices = array('H')
+
+    next_addr = 0
+    for lo, hi, val in entries:
+        if lo > next_addr:
+            starts += addr_to_bytes(next_addr, addr_bytes)
+            indices.append(GEOIP_BINARY_NO_COUNTRY)
+        if val not in country_index:
+            code = val.encode('ascii')
+            if len(code) != 2:
+                raise ValueError("Bad country code %r" % val)
+            country_index[val] = len(countries)
+            countries.append(code)
+        starts += addr_to_bytes(lo, addr_bytes)
+        indices.append(country_index[val])
+        next_addr = hi + 1
+    if next_addr < 1 << (addr_bytes * 8):
+        starts += addr_to_bytes(next_addr, addr_bytes)
+        indices.append(GEOIP_BINARY_NO_COUNTRY)
+
+    if sys.byteorder == 'little':
+        indices.byteswap()
+    with open(filename, 'wb') as fobj:
+        fobj.write(struct.pack(GEOIP_BINARY_HEADER, GEOIP_BINARY_MAGIC,
+                               GEOIP_BINARY_VERSION, addr_bytes,
+                               len(countries), len(indices)))
+        fobj.write(b''.join(countries))
+        fobj.write(starts)
+        fobj.write(indices.tobytes())
+
+def main(args):
+    "Parse the command line in args, and convert the file it names."
+    parser = argparse.ArgumentParser(
+        description="Convert a MaxMind-DB file into Tor's geoip and geoip6 "
+                    "files, in the current directory.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Convert subtrees in this many processes "
+                             "(default: 1)")
+    parser.add_argument('--split-depth', type=int,
+                        default=DEFAULT_SPLIT_DEPTH,
+                        help="With --jobs, split the tree into subtrees this "
+                             "many branches below the root (default: %d)"
+                             % DEFAULT_SPLIT_DEPTH)
+    parser.add_argument('--diff-geoip', metavar='OLD_GEOIP',
+                        help="Report how the new geoip file differs from "
+                             "this one")
+    parser.add_argument('--diff-geoip6', metavar='OLD_GEOIP6',
+                        help="Report how the new geoip6 file differs from "
+                             "this one")
+    parser.add_argument('--diff-report', metavar='FILE', default='-',
+                        help="Where to write the differences (default: "
+                             "stdout)")
+    parser.add_argument('--binary', action='store_true',
+                        help="Also write geoip.bin and geoip6.bin, in a "
+                             "binary format that can be searched in place")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="Write timings, memory use and counters for "
+                             "each phase of the conversion to FILE ('-' for "
+                             "stdout), as JSON")
+    parser.add_argument('mmdb_file',
+                        help="The MaxMind-DB file to convert, which may be "
+                             "gzip-compressed")
+    options = parser.parse_args(args)
+    stats.enabled = bool(options.stats)
+    if (options.stats == '-' and options.diff_report == '-' and
+        (options.diff_geoip or options.diff_geoip6)):
+        parser.error("--stats and --diff-report can't both write to stdout")
+
+    with stats.phase('open'):
+        s = open_mm_file(options.mmdb_file)
+    metadata, the_tree, _ = parse_mm_file(s)
+
+    # Write to temporary files first, so that we can diff them against
+    # the old geoip files even if they're the ones we're replacing.
+    try:
+        write_geoip_files('geoip.tmp', 'geoip6.tmp', metadata, the_tree,
+                          options.mmdb_file, options.jobs, options.split_depth,
+                          s)
+
+        if options.diff_geoip or options.diff_geoip6:
+            with stats.phase('diff'):
+                if options.diff_report == '-':
+                    out = sys.stdout
+                else:
+                    out = open(options.diff_report, 'w')
+                if options.diff_geoip:
+                    write_geoip_diff(out, options.diff_geoip, 'geoip.tmp',
+                                     int, fmt_item_ipv4)
+                if options.diff_geoip6:
+                    write_geoip_diff(out, options.diff_geoip6, 'geoip6.tmp',
+                                     parse_ipv6_addr, fmt_item_ipv6)
+                if out is not sys.stdout:
+                    out.close()
+
+        if options.binary:
+            with stats.phase('binary'):
+                write_geoip_binary('geoip.bin',
+                                   read_geoip_file('geoip.tmp', int), 4)
+                write_geoip_binary('geoip6.bin',
+                                   read_geoip_file('geoip6.tmp',
+                                                   parse_ipv6_addr),
+                                   16)
+    except:
+        for filename in ('geoip.tmp', 'geoip6.tmp'):
+            if os.path.exists(filename):
+                os.remove(filename)
+        raise
+
+    for filename in ('geoip', 'geoip6'):
+        # os.replace is atomic, so there's always a geoip file.
+        os.replace(filename + '.tmp', filename)
+
+    if options.stats:
+        stats.add('jobs', options.jobs)
+        if options.stats == '-':
+            stats.write_json(sys.stdout)
+        else:
+            with open(options.stats, 'w') as out:
+                stats.write_json(out)
 
-write_geoip_file('geoip', metadata, the_tree, dump_item_ipv4, fmt_item_ipv4)
-write_geoip_file('geoip6', metadata, the_tree, dump_item_ipv6, fmt_item_ipv6)
+if __name__ == '__main__':
+    main(sys.argv[1:])